@@ -115,7 +115,9 @@ read_format = 'delta'
 write_format = 'delta'
 
 data = spark.read.format(read_format).load(batch_source_path)
-data.cache().createOrReplaceTempView("batched_orders")
+
+# Cached until the last of the three tables extracted from it has been written
+cache_manager.register("batched_orders", data, consumers=[sales_reps_table, orders_table, line_items_table])
 
 # COMMAND ----------
 
@@ -187,6 +189,7 @@ prep_data  = formated_data.drop("submitted_at","order_id","customer_id","shippin
 final_data = prep_data.dropDuplicates(["sales_rep_id","sales_rep_ssn","sales_rep_first_name","sales_rep_city","sales_rep_state","sales_rep_zip","_error_ssn_format"])
 final_data.createOrReplaceTempView("final_data")
 final_data.write.mode("overwrite").saveAsTable("sales_reps")
+cache_manager.release("batched_orders", sales_reps_table)
 
 
 # COMMAND ----------
@@ -257,6 +260,7 @@ prep_data = select_data.withColumn("submitted_yyyy_mm", date_format(col("submitt
 
 spark.sql("DROP TABLE IF EXISTS orders")
 prep_data.dropDuplicates().write.mode("overwrite").partitionBy("submitted_yyyy_mm").saveAsTable("orders")
+cache_manager.release("batched_orders", orders_table)
 
 
 # COMMAND ----------
@@ -313,6 +317,7 @@ batch_temp_view = spark.sql("SELECT * FROM batched_orders")
 filter_data = batch_temp_view.select("order_id", "product_id", "product_quantity", "product_sold_price", "ingest_file_name", "ingested_at")
 prep_data = filter_data.withColumn("product_quantity", col("product_quantity").cast(IntegerType())).withColumn("product_sold_price", col("product_sold_price").cast(DecimalType(10,2)))
 prep_data.write.mode("overwrite").saveAsTable("line_items")
+cache_manager.release("batched_orders", line_items_table)
 
 # COMMAND ----------
 
@@ -11,22 +11,66 @@
 
 # COMMAND ----------
 
-# Excludes lesson name so as to drop all lessons.
-base_dir = f"dbfs:/user/{clean_username}/dbacademy/{clean_course_name}"
-print(f"""Deleting the course directory...""")
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+reset_workers = 8
+reset_start = time.time()
+reset_pool = ThreadPoolExecutor(max_workers=reset_workers)
+
+# Deletes the tree under path by handing its subtrees to the worker pool, confirming the
+# removal by re-listing rather than sleeping. Returns the number of subtrees & files removed.
+def delete_tree(path:str) -> int:
+  list_all = lambda dirs: [f for files in reset_pool.map(lambda d: dbutils.fs.ls(d.path), dirs) for f in files]
+  if not path_exists(path): return 0
+  units = dbutils.fs.ls(path)
+
+  # Expand directories until there is enough work to go around
+  while BI.len(units) < reset_workers * 4 and BI.any(f.is_dir for f in units):
+    units = [f for f in units if not f.is_dir] + list_all([f for f in units if f.is_dir])
+
+  removed = 0
+  while BI.len(units) > 0:
+    results = list(reset_pool.map(lambda f: dbutils.fs.rm(f.path, True), units))
+    failed = [f for f, deleted in zip(units, results) if deleted == False]
+    removed += BI.len(units) - BI.len(failed)
+    units = list_all([f for f in failed if f.is_dir])
+
+  dbutils.fs.rm(path, True) # Only the emptied directories remain
+  if path_exists(path): raise IOError(f"Unable to delete directory: {path}")
+  return removed
 
-dbutils.fs.rm(base_dir, True)
-print(f"""Deleted "{base_dir}" """)
+def path_exists(path:str) -> bool:
+  try: 
+    dbutils.fs.ls(path)
+    return True
+  except Exception: 
+    return False
 
 # COMMAND ----------
 
+# Excludes lesson name so as to drop all lessons.
+base_dir = f"dbfs:/user/{clean_username}/dbacademy/{clean_course_name}"
+print(f"""Deleting the course directory...""")
+
 # Excludes lesson name so as to drop all databases.
 db_name = f"""dbacademy_{clean_username}_{clean_course_name}"""
+db_names = list(filter(lambda name: name.startswith(db_name), map(lambda d: d.name, spark.catalog.listDatabases())))
 print(f"""Dropping all databases that start with "{db_name}" """)
 
-for name in list(filter(lambda name: name.startswith(db_name), map(lambda d: d.name, spark.catalog.listDatabases()))):
-  spark.sql(f"DROP DATABASE IF EXISTS {name} CASCADE")
-  print(f"""Dropped the database "{name}".""")
+# The directory & the databases are independent, so they are removed side by side
+# (delete_tree() gets its own thread as it waits on the shared pool)
+files_removed = ThreadPoolExecutor(max_workers=1).submit(delete_tree, base_dir)
+list(reset_pool.map(lambda name: spark.sql(f"DROP DATABASE IF EXISTS {name} CASCADE"), db_names))
+
+remaining = set(db_names) & set(map(lambda d: d.name, spark.catalog.listDatabases()))
+if remaining: raise Exception(f"Unable to drop the databases {', '.join(sorted(remaining))}")
+for name in db_names: print(f"""Dropped the database "{name}".""")
+
+print(f"""Deleted "{base_dir}" ({files_removed.result():,d} files & directories)""")
+reset_pool.shutdown()
+
+print(f"Removed {BI.len(db_names)} databases and the course directory in {time.time() - reset_start:.1f} seconds")
 
 # COMMAND ----------
 
@@ -301,6 +301,7 @@ class TestSuite(object):
   
   def runTests(self) -> List[TestResult]:
     import re
+    deferred_scalars.evaluate() # One job per table for all of the pending aggregates
     failedTests = set()
     testResults = list()
     
@@ -474,6 +475,402 @@ None # Suppress Output
 
 # COMMAND ----------
 
+#############################################
+# Deferred scalars
+#############################################
+
+# A single aggregate value of a table, computed when first needed
+class DeferredScalar(object):
+  __slots__ = ("batch", "table_name", "expression", "resolved", "value", "exception")
+  def __init__(self, batch, table_name:str, expression):
+    self.batch = batch
+    self.table_name = table_name
+    self.expression = expression
+    self.resolved = False
+    self.value = None
+    self.exception = None
+
+  def get(self):
+    if not self.resolved: self.batch.evaluate(self.table_name)
+    if self.exception is not None: raise self.exception
+    return self.value
+
+# Collects aggregate lookups, e.g. the count and the min & max of several columns, and
+# evaluates all that are pending against the same table in a single agg() job. TestSuite
+# evaluates every pending scalar before running its tests; should that job fail (e.g. the
+# table does not exist), each scalar raises the failure from get() instead.
+class DeferredScalars(object):
+  def __init__(self):
+    self.pending = dict() # table name -> [DeferredScalar]
+
+  def scalar(self, table_name:str, expression) -> DeferredScalar:
+    future = DeferredScalar(self, table_name, expression)
+    self.pending.setdefault(table_name, []).append(future)
+    return future
+
+  def count(self, table_name:str) -> DeferredScalar:
+    return self.scalar(table_name, FT.count(FT.lit(1)))
+
+  def count_where(self, table_name:str, condition) -> DeferredScalar:
+    return self.scalar(table_name, FT.count(FT.when(condition, 1)))
+
+  def min(self, table_name:str, column:str) -> DeferredScalar:
+    return self.scalar(table_name, FT.min(FT.col(column)))
+
+  def max(self, table_name:str, column:str) -> DeferredScalar:
+    return self.scalar(table_name, FT.max(FT.col(column)))
+
+  def evaluate(self, table_name:str=None):
+    for name in ([table_name] if table_name else BI.list(self.pending.keys())):
+      futures = self.pending.pop(name, [])
+      if not futures: continue
+      try:
+        row = spark.read.table(name).agg(*[f.expression.alias(f"_{i}") for i, f in enumerate(futures)]).first()
+        for i, future in enumerate(futures): future.value = row[i]
+      except Exception as e:
+        for future in futures: future.exception = e
+      for future in futures: future.resolved = True
+
+deferred_scalars = DeferredScalars()
+
+None # Suppress Output
+
+# COMMAND ----------
+
+#############################################
+# Cache lifecycle management
+#############################################
+
+# A cached temp view, the consumers still expected to read it and its LRU timestamp
+class CachedView(object):
+  __slots__ = ("name", "df", "consumers", "cached", "last_used")
+  def __init__(self, name:str, df, consumers:Iterable[str]):
+    self.name = name
+    self.df = df
+    self.consumers = set(consumers)
+    self.cached = False
+    self.last_used = 0
+
+# Caches temp views on behalf of their expected consumers and unpersists each view as
+# soon as its last consumer releases it, or when the notebook's Python process exits.
+# With a budget_bytes, the least recently used views are evicted whenever the cached
+# bytes exceed the budget; an evicted view is re-cached on its next acquire().
+#
+# Views are cached with spark.catalog.cacheTable() so their blocks carry the view's
+# name ("In-memory table <name>") and can be attributed in getRDDStorageInfo().
+class CacheManager(object):
+  def __init__(self, budget_bytes:int=None):
+    import atexit
+    self.views = dict()
+    self.budget_bytes = budget_bytes
+    atexit.register(self.release_all)
+
+  def register(self, name:str, df, consumers:Iterable[str]):
+    if name in self.views: self._uncache(self.views[name])
+    view = CachedView(name, df, consumers)
+    self.views[name] = view
+    df.createOrReplaceTempView(name)
+    self._cache(view)
+    self._touch(view) # Sets last_used & evicts past the budget, as acquire() does
+    return df
+
+  def acquire(self, name:str, consumer:str=None):
+    view = self.views[name]
+    if consumer: view.consumers.add(consumer)
+    if not view.cached: self._cache(view)
+    self._touch(view)
+    return spark.read.table(name)
+
+  def release(self, name:str, consumer:str):
+    view = self.views.get(name)
+    if view is None: return
+    view.consumers.discard(consumer)
+    if BI.len(view.consumers) == 0:
+      self._uncache(view)
+      del self.views[name]
+
+  # Context manager for a single consumer: with cache_manager.use(view, consumer) as df: ...
+  def use(self, name:str, consumer:str):
+    from contextlib import contextmanager
+    @contextmanager
+    def scope():
+      try: yield self.acquire(name, consumer)
+      finally: self.release(name, consumer)
+    return scope()
+
+  def release_all(self):
+    for view in BI.list(self.views.values()):
+      self._uncache(view)
+    self.views.clear()
+
+  # Bytes held in memory and on disk for each cached view
+  def cached_bytes(self) -> dict:
+    sizes = {name: 0 for name, view in self.views.items() if view.cached}
+    for info in sc._jsc.sc().getRDDStorageInfo():
+      for name in sizes:
+        if info.name() == f"In-memory table {name}":
+          sizes[name] += info.memSize() + info.diskSize()
+    return sizes
+
+  def enforce_budget(self, keep:str=None):
+    if self.budget_bytes is None: return
+    sizes = self.cached_bytes()
+    total = BI.sum(sizes.values())
+    for view in BI.sorted([v for v in self.views.values() if v.cached and v.name != keep], key=lambda v: v.last_used):
+      if total <= self.budget_bytes: break
+      print(f"Evicting {view.name} ({sizes.get(view.name, 0):,d} bytes) from the cache")
+      self._uncache(view)
+      total -= sizes.get(view.name, 0)
+
+  def _touch(self, view):
+    import time
+    view.last_used = time.monotonic()
+    self.enforce_budget(keep=view.name)
+
+  def _cache(self, view):
+    spark.catalog.cacheTable(view.name)
+    view.cached = True
+
+  def _uncache(self, view):
+    if view.cached:
+      try: spark.catalog.uncacheTable(view.name)
+      except Exception: pass # The view may already have been dropped
+    view.cached = False
+
+# Keep the existing manager, and the views it tracks, when a setup notebook is re-run
+try: cache_manager
+except NameError: cache_manager = CacheManager()
+
+None # Suppress Output
+
+# COMMAND ----------
+
+#############################################
+# Streaming query events
+#############################################
+
+# Blocks until a streaming query starts or its progress satisfies a condition. When the
+# streaming query listener is available (Spark 3.4+) every start, progress and termination
+# event wakes the waiters; otherwise a background thread polls each active query's
+# lastProgress every poll_seconds, filling any gap from recentProgress, and publishes the
+# same events. Either way the timeout is measured against a single deadline rather than
+# accumulated sleeps.
+class StreamEvents(object):
+  def __init__(self, poll_seconds:float=0.25):
+    import threading
+    self.condition = threading.Condition()
+    self.poll_seconds = poll_seconds
+    self.subscribers = []            # Called with the progress (as a dict) of every progress event
+    self.terminated_subscribers = [] # Called with the run id of every query that stops
+    self.listening = self._register()
+    if not self.listening: threading.Thread(target=self._poll, daemon=True).start()
+
+  def find(self, name:str):
+    return next((q for q in spark.streams.active if q.name == name), None)
+
+  # Waits for predicate() to return a truthy value, which is returned
+  def wait_until(self, predicate, timeout:float, description:str):
+    import time
+    deadline = time.monotonic() + timeout
+    with self.condition:
+      while True:
+        result = predicate()
+        if result: return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: raise Exception(f"Timed out waiting for {description}")
+        self.condition.wait(remaining if self.listening else BI.min(remaining, self.poll_seconds))
+
+  def wait_for_start(self, name:str, timeout:float=60):
+    return self.wait_until(lambda: self.find(name), timeout, f'the stream "{name}" to start')
+
+  # Waits for count progress events, or for predicate(recentProgress) to hold
+  def wait_for_progress(self, name:str, count:int=1, predicate=None, timeout:float=60):
+    def ready():
+      query = self.find(name)
+      if query is None: return None
+      progress = query.recentProgress
+      done = predicate(progress) if predicate else BI.len(progress) >= count
+      return query if done else None
+    return self.wait_until(ready, timeout, f'the progress of the stream "{name}"')
+
+  def _notify(self):
+    with self.condition: self.condition.notify_all()
+
+  def _register(self):
+    try: from pyspark.sql.streaming import StreamingQueryListener
+    except ImportError: return False
+
+    events = self
+    class Listener(StreamingQueryListener):
+      def onQueryStarted(self, event): events._notify()
+      def onQueryProgress(self, event):
+        import json
+        progress = json.loads(event.progress.json)
+        for subscriber in events.subscribers: subscriber(progress)
+        events._notify()
+      def onQueryIdle(self, event): pass
+      def onQueryTerminated(self, event):
+        for subscriber in events.terminated_subscribers: subscriber(str(event.runId))
+        events._notify()
+
+    spark.streams.addListener(Listener())
+    return True
+
+  # Publishes the progress of query newer than the last batch seen for its run; a skipped
+  # batch id (or a query that just stopped) is caught up from recentProgress
+  def _publish(self, query, seen:dict, stopped:bool=False):
+    run_id = str(query.runId)
+    last = seen.get(run_id, -1)
+    progress = query.lastProgress
+    if progress is None or (progress["batchId"] <= last and not stopped): return
+
+    for p in (query.recentProgress if stopped or progress["batchId"] > last + 1 else [progress]):
+      if p["batchId"] > last:
+        for subscriber in self.subscribers: subscriber(p)
+        last = p["batchId"]
+    seen[run_id] = last
+
+  def _poll(self):
+    import time
+    seen = dict()    # run id -> last batch id published
+    running = dict() # run id -> query, to publish its final progress once it stops
+    while True:
+      time.sleep(self.poll_seconds)
+      try:
+        active = {str(q.runId): q for q in spark.streams.active}
+        for run_id, query in BI.list(running.items()):
+          if run_id in active: continue
+          del running[run_id]
+          self._publish(query, seen, stopped=True)
+          for subscriber in self.terminated_subscribers: subscriber(run_id)
+        for run_id, query in active.items():
+          running[run_id] = query
+          self._publish(query, seen)
+      except Exception as e:
+        print(f"Unable to poll the streaming queries: {e}") # Retried on the next poll
+      self._notify()
+
+# The id of the query recorded in a checkpoint, written when the query first starts.
+# A reset checkpoint gets a new id, so keying txnAppId by it rather than by the query name
+# keeps the restarted batch ids from being skipped as already committed.
+def checkpoint_query_id(checkpoint_path):
+  import json
+  return json.loads(dbutils.fs.head(f"{checkpoint_path}/metadata").split("\n")[0])["id"]
+
+# Register the listener only once per Python process
+try: stream_events
+except NameError: stream_events = StreamEvents()
+
+None # Suppress Output
+
+# COMMAND ----------
+
+#############################################
+# Streaming progress history
+#############################################
+
+# One trigger of one query, reduced to the fields the history is queried by
+class ProgressEntry(object):
+  __slots__ = ("name", "run_id", "batch_id", "timestamp", "num_input_rows", "input_rows_per_second", "processed_rows_per_second", "duration_ms", "state_operators")
+  def __init__(self, progress:dict):
+    from datetime import datetime, timezone
+    self.name = progress.get("name")
+    self.run_id = progress.get("runId")
+    self.batch_id = progress.get("batchId")
+    self.timestamp = datetime.strptime(progress["timestamp"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc).timestamp()
+    self.num_input_rows = progress.get("numInputRows", 0)
+    self.input_rows_per_second = progress.get("inputRowsPerSecond") or 0.0
+    self.processed_rows_per_second = progress.get("processedRowsPerSecond") or 0.0
+    self.duration_ms = progress.get("durationMs", {}).get("triggerExecution", 0)
+    # The numeric metrics of each stateful operator, e.g. numRowsTotal & numRowsDroppedByWatermark
+    self.state_operators = [{k: v for k, v in op.items() if isinstance(v, int)} for op in progress.get("stateOperators", [])]
+
+  def as_tuple(self):
+    return tuple(getattr(self, f) for f in ProgressEntry.__slots__)
+
+# Records every progress event of every query, unlike recentProgress which only keeps the
+# last few triggers and is copied over py4j on every access. Entries are kept in a ring of
+# capacity entries, indexed by (query name, run id) and batch id, and, when table_name is
+# specified, appended to a Delta table every flush_rows entries so days of history survive.
+# Queries default to the most recent run of the named query.
+#
+# Entries arrive through stream_events, from the listener (Spark 3.4+) or its poller, and
+# pending rows are flushed when a query stops. sync(query) records any entries of
+# recentProgress not yet seen.
+class ProgressHistory(object):
+  def __init__(self, capacity:int=100000, table_name:str=None, flush_rows:int=1000):
+    from collections import deque
+    self.ring = deque()
+    self.capacity = capacity
+    self.index = dict()    # (name, run_id) -> {batch_id: entry}
+    self.last_run = dict() # name -> run_id
+    self.table_name = table_name
+    self.flush_rows = flush_rows
+    self.pending = []
+
+  def record(self, progress:dict):
+    entry = ProgressEntry(progress)
+    batches = self.index.setdefault((entry.name, entry.run_id), dict())
+    if entry.batch_id in batches: return
+
+    if BI.len(self.ring) == self.capacity:
+      old = self.ring.popleft()
+      self.index.get((old.name, old.run_id), {}).pop(old.batch_id, None)
+    self.ring.append(entry)
+    batches[entry.batch_id] = entry
+    self.last_run[entry.name] = entry.run_id
+
+    if self.table_name:
+      self.pending.append(entry.as_tuple())
+      if BI.len(self.pending) >= self.flush_rows: self.flush()
+
+  def sync(self, query):
+    batches = self.index.get((query.name, str(query.runId)), {})
+    for progress in query.recentProgress:
+      if progress["batchId"] not in batches: self.record(progress)
+
+  def flush(self):
+    if not self.pending: return
+    rows, self.pending = self.pending, []
+    schema = "name string, run_id string, batch_id long, timestamp double, num_input_rows long, input_rows_per_second double, processed_rows_per_second double, duration_ms long, state_operators array<map<string,long>>"
+    spark.createDataFrame(rows, schema).write.format("delta").mode("append").option("mergeSchema", "true").saveAsTable(self.table_name)
+
+  def entries(self, name:str, run_id:str=None, batch_ids=None, start:float=None, end:float=None) -> List[ProgressEntry]:
+    batches = self.index.get((name, run_id or self.last_run.get(name)), {})
+    if batch_ids is not None: selected = [batches[b] for b in batch_ids if b in batches]
+    else: selected = BI.list(batches.values())
+    if start is not None: selected = [e for e in selected if e.timestamp >= start]
+    if end is not None: selected = [e for e in selected if e.timestamp < end]
+    return BI.sorted(selected, key=lambda e: e.batch_id)
+
+  def count(self, name:str, run_id:str=None) -> int:
+    return BI.len(self.index.get((name, run_id or self.last_run.get(name)), {}))
+
+  def rows_per_trigger(self, name:str, run_id:str=None) -> List[int]:
+    return [e.num_input_rows for e in self.entries(name, run_id)]
+
+  def rate_percentiles(self, name:str, percentiles=(50, 90, 99), run_id:str=None) -> dict:
+    rates = BI.sorted(e.processed_rows_per_second for e in self.entries(name, run_id))
+    if not rates: return {p: None for p in percentiles}
+    return {p: rates[BI.min(BI.len(rates)-1, int(BI.round(p / 100 * (BI.len(rates)-1))))] for p in percentiles}
+
+  # Number of triggers whose duration falls under each bucket's upper bound (in ms)
+  def duration_histogram(self, name:str, buckets=(100, 500, 1000, 5000, 10000, 60000), run_id:str=None) -> dict:
+    histogram = {b: 0 for b in BI.list(buckets) + [float("inf")]}
+    for e in self.entries(name, run_id):
+      histogram[next(b for b in histogram if e.duration_ms < b)] += 1
+    return histogram
+
+try: progress_history
+except NameError:
+  progress_history = ProgressHistory()
+  stream_events.subscribers.append(progress_history.record)
+  stream_events.terminated_subscribers.append(lambda run_id: progress_history.flush())
+
+None # Suppress Output
+
+# COMMAND ----------
+
 import re
 
 # The user's name (email address) will be used to create a home directory into which all datasets will
@@ -492,6 +889,9 @@ clean_course_name = re.sub("[^a-zA-Z0-9]", "_", dataset_name)
 working_dir = f"dbfs:/user/{username}/dbacademy/{dataset_name}"
 meta_dir = f"{working_dir}/raw/orders/batch/2017.txt"
 
+batch_dir = f"{working_dir}/raw/orders/batch"
+batch_checkpoint_path = f"{working_dir}/checkpoint/batch_orders"
+
 batch_2017_path = f"{working_dir}/raw/orders/batch/2017.txt"
 batch_2018_path = f"{working_dir}/raw/orders/batch/2018.csv"
 batch_2019_path = f"{working_dir}/raw/orders/batch/2019.csv"
@@ -500,6 +900,8 @@ batch_target_path = f"{working_dir}/batch_orders_dirty.delta"
 stream_path =                        f"{working_dir}/raw/orders/stream"
 orders_checkpoint_path =             f"{working_dir}/checkpoint/orders"
 line_items_checkpoint_path =         f"{working_dir}/checkpoint/line_items"
+stream_orders_checkpoint_path =      f"{working_dir}/checkpoint/stream_orders"
+stream_orders_staging_path =         f"{working_dir}/staging/stream_orders"
 
 products_xsd_path = f"{working_dir}/raw/products/products.xsd"
 products_xml_path = f"{working_dir}/raw/products/products.xml"
@@ -519,6 +921,10 @@ question_1_results_table = "question_1_results"
 question_2_results_table = "question_2_results"
 question_3_results_table = "question_3_results"
 
+# Python file APIs reach DBFS through the local FUSE mount, on the driver and the workers
+def to_local_path(path):
+  return "/dbfs/" + path[len("dbfs:/"):] if path.startswith("dbfs:/") else path
+
 def load_meta():
   global meta, meta_batch_count_2017, meta_batch_count_2018, meta_batch_count_2019, meta_products_count, meta_orders_count, meta_line_items_count, meta_sales_reps_count, meta_stream_count, meta_ssn_format_count
   
@@ -3,6 +3,10 @@
 
 # COMMAND ----------
 
+# MAGIC %run ./Utilities-Ingestion
+
+# COMMAND ----------
+
 load_meta()
 
 # COMMAND ----------
@@ -17,6 +21,8 @@ html += html_row_var("batch_2017_path", batch_2017_path, """The path to the 2017
 html += html_row_var("batch_2018_path", batch_2018_path, """The path to the 2018 batch of orders""")
 html += html_row_var("batch_2019_path", batch_2019_path, """The path to the 2019 batch of orders""")
 html += html_row_var("batch_target_path", batch_target_path, """The location of the new, unified, raw, batch of orders & sales reps""")
+html += html_row_var("batch_checkpoint_path", batch_checkpoint_path, """The location of the checkpoint for incrementally ingested batch files""")
+html += html_row_fun("ingest_batch_orders()", """A utility function that ingests only the new files in the batch directory, then stops""")
 
 
 html += html_reality_check("reality_check_02_a()", "2.A")
@@ -3,6 +3,10 @@
 
 # COMMAND ----------
 
+# MAGIC %run ./Utilities-Tables
+
+# COMMAND ----------
+
 load_meta()
 
 # COMMAND ----------
@@ -20,6 +24,10 @@ html += html_orders_table()
 html += html_line_items_table()
 html += html_sales_reps_table()
 html += html_row_var("batch_temp_view", batch_temp_view, """The name of the temp view used in this exercise""")
+html += html_row_fun("fan_out_write()", """A utility function that writes several tables from one scan of a source DataFrame""")
+html += html_row_fun("batch_orders_targets()", """The sales-reps, orders & line-items tables as targets of <b>fan_out_write()</b>, deduplicated as this exercise requires""")
+html += html_row_fun("upsert_dimension()", """A utility function that merges only new or changed rows into a dimension table""")
+html += html_row_fun("analyze_partition_layouts()", """A utility function that recommends a partition layout for the orders table""")
 
 html += html_reality_check("reality_check_03_a()", "3.A")
 html += html_reality_check("reality_check_03_b()", "3.B")
@@ -164,11 +172,14 @@ def reality_check_03_c():
   suite.test(f"{suite_name}.schema", "Schema is valid", dependsOn=[suite.lastTestId()], 
              testFunction = lambda: checkSchema(spark.read.table(sales_reps_table).schema, expectedSalesRepSchema, False, False))
 
+  sales_reps_count = deferred_scalars.count(sales_reps_table)
+  ssn_format_count = deferred_scalars.count_where(sales_reps_table, FT.col("_error_ssn_format") == True)
+
   suite.test(f"{suite_name}.count-total", f"Expected {meta_sales_reps_count:,d} records", dependsOn=[suite.lastTestId()],
-             testFunction = lambda: spark.read.table(sales_reps_table).count() == meta_sales_reps_count)
+             testFunction = lambda: sales_reps_count.get() == meta_sales_reps_count)
 
   suite.test(f"{suite_name}.count-ssn-format", f"Expected _error_ssn_format record count to be {meta_ssn_format_count:,d}", dependsOn=[suite.lastTestId()], 
-             testFunction = lambda: spark.read.table(sales_reps_table).filter("_error_ssn_format == true").count() == meta_ssn_format_count)
+             testFunction = lambda: ssn_format_count.get() == meta_ssn_format_count)
 
   daLogger.logSuite(suite_name, registration_id, suite)
   
@@ -199,11 +210,14 @@ def reality_check_03_d():
   suite.test(f"{suite_name}.schema", "Schema is valid", dependsOn=[suite.lastTestId()],
              testFunction = lambda: checkSchema(spark.read.table(orders_table).schema, expectedOrdersSchema, False, False))
 
+  orders_count = deferred_scalars.count(orders_table)
+  null_submitted_at_count = deferred_scalars.count_where(orders_table, FT.col("submitted_at").isNull())
+
   suite.test(f"{suite_name}.count-total", f"Expected {meta_orders_count:,d} records", dependsOn=[suite.lastTestId()],
-             testFunction = lambda: spark.read.table(orders_table).count() == meta_orders_count)
+             testFunction = lambda: orders_count.get() == meta_orders_count)
 
   suite.test(f"{suite_name}.non-null-submitted_at", f"Non-null (properly parsed) submitted_at", dependsOn=[suite.lastTestId()],
-             testFunction = lambda: spark.read.table(orders_table).filter(FT.col("submitted_at").isNull()).count() == 0)
+             testFunction = lambda: null_submitted_at_count.get() == 0)
 
   def is_partitioned():
     files = BI.filter(lambda p: p.endswith("_delta_log/") == False, BI.map(lambda f: f.path, dbutils.fs.ls(hive_path)))
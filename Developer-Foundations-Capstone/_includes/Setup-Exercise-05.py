@@ -3,6 +3,14 @@
 
 # COMMAND ----------
 
+# MAGIC %run ./Utilities-Tables
+
+# COMMAND ----------
+
+# MAGIC %run ./Utilities-Streaming
+
+# COMMAND ----------
+
 load_meta()
 
 # COMMAND ----------
@@ -21,6 +29,12 @@ html += html_line_items_table()
 html += html_row_var("stream_path", stream_path, """The path to the stream directory of JSON orders""")
 html += html_row_var("orders_checkpoint_path", orders_checkpoint_path, """The location of the checkpoint for streamed orders""")
 html += html_row_var("line_items_checkpoint_path", line_items_checkpoint_path, """The location of the checkpoint for streamed line-items""")
+html += html_row_var("stream_orders_checkpoint_path", stream_orders_checkpoint_path, """The location of the single checkpoint used by start_stream_orders()""")
+html += html_row_fun("start_stream_orders()", """A utility function that streams orders and line-items from one read of the source into both tables""")
+html += html_row_fun("dedup_metrics()", """A utility function that reports the state size, evictions and dropped duplicates of a deduplicating stream per trigger""")
+html += html_row_fun("CoalescingSink", """A foreachBatch sink that stages micro-batches and commits them in bulk, see <b>start_stream_orders(coalesce=True)</b>""")
+html += html_row_fun("start_adaptive_stream_orders()", """Like start_stream_orders() but grows or shrinks the files admitted per trigger with the backlog; <b>test_mode=True</b> keeps one file per trigger""")
+html += html_row_fun("StreamReplayer", """Drip-feeds files or records into a directory at a controlled (or bursty) rate, or replays a dataset in event-time order""")
 
 html += html_reality_check("reality_check_05_a()", "5.A")
 html += html_reality_check("reality_check_05_b()", "5.B")
@@ -34,46 +48,27 @@ displayHTML(html)
 # COMMAND ----------
 
 def wait_for_stream_start(name, max_count):
-  import time
+  print(f"""Waiting for the stream "{name}" to start...""")
+  query = stream_events.wait_for_start(name, timeout=60)
+  run_id = str(query.runId)
+  print(f"""The stream "{name}" has started.""")
 
-  timeout = 60
-  while BI.len(BI.list(BI.filter(lambda query: query.name == name, spark.streams.active))) == 0:
-    print(f"""Waiting for the stream "{name}" to start...""")
-    time.sleep(5) # Give it a couple of seconds
-    timeout -= 5  # Decrement our timer
-    if (timeout <= 0): raise Exception("Timed out waiting for the query to start")
+  stream_events.wait_until(lambda: progress_history.count(name, run_id) >= 1, 60, f'the progress of the stream "{name}"')
+  print(f"""The stream has processed {progress_history.count(name, run_id)} triggers so far.""")
 
-  query = BI.list(BI.filter(lambda query: query.name == name, spark.streams.active))[0]
-  print(f"""The stream "{name}" has started.""")
-      
-  timeout = 60
-  while BI.len(query.recentProgress) == 0:
-    print(f"""The stream hasn't processed any trigger yet...""")
-    time.sleep(5) # Give it a couple of seconds
-    timeout -= 5  # Decrement our timer
-    if (timeout <= 0): raise Exception("Timed out waiting for the first trigger")
-    
-  if BI.len(query.recentProgress) == 1: print(f"""The stream has processed {BI.len(query.recentProgress)} triggers so far.""")
-  else: print(f"""The stream has processed {BI.len(query.recentProgress)} triggers so far.""")
-
-  timeout = 60*5
-  while BI.len(query.recentProgress) < max_count:
-    print(f"Processing trigger {BI.len(query.recentProgress)+1} of {max_count}...")
-    if query.recentProgress[-1]["numInputRows"] > 1:
-      raise Exception(f"Expected 1 record per trigger, found {query.recentProgress[-1]['numInputRows']}, aborting all tests.")
-
-    time.sleep(5) # Give it a couple of seconds
-    timeout -= 5  # Decrement our timer
-    if (timeout <= 0): raise Exception("Timed out waiting for all events to be processed")
-  
+  def all_processed():
+    rows = progress_history.rows_per_trigger(name, run_id)
+    if rows[-1] > 1:
+      raise Exception(f"Expected 1 record per trigger, found {rows[-1]}, aborting all tests.")
+    return BI.len(rows) >= max_count
+
+  print(f"Processing {max_count} triggers...")
+  stream_events.wait_until(all_processed, 60*5, f'{max_count} triggers of the stream "{name}"')
   return query
 
 def first_n_equal_one(name):
-  query = BI.list(BI.filter(lambda query: query.name == name, spark.streams.active))[0]
-  for i in range(0, meta_stream_count):
-    if query.recentProgress[i]["numInputRows"] != 1:
-      return False
-  return True
+  rows = progress_history.rows_per_trigger(name)
+  return BI.len(rows) >= meta_stream_count and BI.all(r == 1 for r in rows[:meta_stream_count])
 
 check_a_passed = False
 check_b_passed = False
@@ -125,10 +120,10 @@ def reality_check_05_b():
     print("Processing results...")
 
     suite.test(f"{suite_name}.min-count", f"Expected at least {meta_stream_count} triggers",
-               testFunction = lambda: BI.len(query.recentProgress) >= meta_stream_count)
+               testFunction = lambda: progress_history.count(query.name) >= meta_stream_count)
 
     suite.test(f"{suite_name}.max-count", f"Expected less than 100 triggers", dependsOn=[suite.lastTestId()], 
-               testFunction = lambda: BI.len(query.recentProgress) < 100)
+               testFunction = lambda: progress_history.count(query.name) < 100)
 
     suite.test(f"{suite_name}.whatever", f"Expected the first {meta_stream_count} triggers to processes 1 record per trigger", 
                dependsOn=[suite.lastTestId()], 
@@ -168,10 +163,10 @@ def reality_check_05_c():
     print("Processing results...")
 
     suite.test(f"{suite_name}.min-count", f"Expected at least {meta_stream_count:,d} triggers", 
-               testFunction = lambda: BI.len(query.recentProgress) >= meta_stream_count)
+               testFunction = lambda: progress_history.count(query.name) >= meta_stream_count)
 
     suite.test(f"{suite_name}.max-count", f"Expected less than 100 triggers", dependsOn=[suite.lastTestId()], 
-               testFunction = lambda: BI.len(query.recentProgress) < 100)
+               testFunction = lambda: progress_history.count(query.name) < 100)
 
     suite.test(f"{suite_name}.whatever", f"Expected the first {meta_stream_count:,d} triggers to processes 1 record per trigger", 
                dependsOn=[suite.lastTestId()], 
@@ -220,9 +215,12 @@ def reality_check_05_final():
   suite.testEquals(f"{suite_name}.c-passed", "Reality Check 05.C passed", check_c_passed, True)
   id_c = suite.lastTestId()
   
+  orders_count = deferred_scalars.count(orders_table)
+  null_submitted_at_count = deferred_scalars.count_where(orders_table, FT.col("submitted_at").isNull())
+
   suite.test(f"{suite_name}.order_total", f"Expected {meta_orders_count + meta_stream_count:,d} orders ({meta_stream_count} new)", 
              dependsOn=[id_a, id_b, id_c], 
-             testFunction = lambda: spark.read.table(orders_table).count() == meta_orders_count + meta_stream_count)
+             testFunction = lambda: orders_count.get() == meta_orders_count + meta_stream_count)
 
   try:
     new_count = spark.read.json(stream_path).select("orderId", FT.explode("products")).count()
@@ -238,7 +236,7 @@ def reality_check_05_final():
              testFunction = lambda: spark.read.table(products_table).count() == meta_products_count)
 
   suite.test(f"{suite_name}.non-null-submitted_at", f"Non-null (properly parsed) submitted_at", dependsOn=[suite.lastTestId()],
-             testFunction = lambda: spark.read.table(orders_table).filter(FT.col("submitted_at").isNull()).count() == 0)
+             testFunction = lambda: null_submitted_at_count.get() == 0)
   
   check_final_passed = suite.passed
 
@@ -3,6 +3,14 @@
 
 # COMMAND ----------
 
+# MAGIC %run ./Utilities-Tables
+
+# COMMAND ----------
+
+# MAGIC %run ./Utilities-Star
+
+# COMMAND ----------
+
 load_meta()
 
 # COMMAND ----------
@@ -23,6 +31,15 @@ html += html_row_var("question_1_results_table", question_1_results_table, """Th
 html += html_row_var("question_2_results_table", question_1_results_table, """The name of the temporary view for the results to question #2.""")
 html += html_row_var("question_3_results_table", question_1_results_table, """The name of the temporary view for the results to question #3.""")
 
+html += html_row_fun("dimension_cache.table()", """Returns a pinned, broadcast-ready copy of a small dimension table, refreshed when the table's version changes""")
+html += html_row_fun("star_view()", """Joins orders, line_items, products and sales_reps on their keys, pruned to the requested columns with filters pushed below the joins, e.g. <b>star_view(["product_sold_price"], filters={"color": "green"})</b>""")
+html += html_row_fun("prune_with_skipping_index()", """Reads only the files of a table whose min/max (and optional bloom filter) summaries can match the filters, e.g. <b>prune_with_skipping_index(orders_table, {"shipping_address_state": "NC"})</b>""")
+html += html_row_fun("zorder_table()", """Clusters a table along the Z-order of several columns and reports the clustering quality before and after, e.g. <b>zorder_table(orders_table, ["shipping_address_state", "sales_rep_id"])</b>""")
+html += html_row_fun("enable_change_data_feed()", """Enables the change data feed on the orders & line-items tables, run once (with no streams writing) before <b>refresh_business_aggregates()</b> can refresh incrementally""")
+html += html_row_fun("refresh_business_aggregates()", """Incrementally refreshes the precomputed answers in <b>business_aggregates</b>, with no streams active, read with e.g. <b>business_aggregates["question_1"].read()</b>""")
+
+html += html_row_fun("build_price_sketches()", """Builds <b>price_sketches</b>, mergeable distinct-customer, quantile and min/avg/max sketches of the sold prices by month, state, color and SSN format""")
+
 html += html_reality_check("reality_check_06_a()", "6.A")
 html += html_reality_check("reality_check_06_b()", "6.B")
 html += html_reality_check("reality_check_06_c()", "6.C")
@@ -157,7 +174,7 @@ def reality_check_06_c(ex_avg, ex_min, ex_max):
     act_min = act_results["min(product_sold_price)"]
     act_max = act_results["max(product_sold_price)"]
 
-    exp_results = spark.read.table(orders_table).join(spark.read.table(sales_reps_table), "sales_rep_id").join(spark.read.table(line_items_table), "order_id").join(spark.read.table(products_table), "product_id").filter(FT.col("shipping_address_state") == "NC").filter(FT.col("_error_ssn_format") == True).filter(FT.col("color") == "green").select(FT.avg("product_sold_price"), FT.min("product_sold_price"), FT.max("product_sold_price")).first()
+    exp_results = star_view(["product_sold_price"], filters={"shipping_address_state": "NC", "_error_ssn_format": True, "color": "green"}).select(FT.avg("product_sold_price"), FT.min("product_sold_price"), FT.max("product_sold_price")).first()
     exp_avg = exp_results["avg(product_sold_price)"]
     exp_min = exp_results["min(product_sold_price)"]
     exp_max = exp_results["max(product_sold_price)"]
@@ -207,10 +224,8 @@ def reality_check_06_d():
     act_first = act_results["sales_rep_first_name"]
     act_last = act_results["sales_rep_last_name"]
 
-    exp_results = (spark.read.table(orders_table).join(
-                   spark.read.table(sales_reps_table), "sales_rep_id").join(
-                   spark.read.table(line_items_table), "order_id").join(
-                   spark.read.table(products_table), "product_id").withColumn("per_product_profit", FT.col("product_sold_price") - FT.col("price")).withColumn("total_profit", FT.col("per_product_profit") * FT.col("product_quantity")).groupBy("sales_rep_id", "sales_rep_first_name", "sales_rep_last_name").sum("total_profit").orderBy(FT.col("sum(total_profit)").desc()).first())
+    exp_results = (star_view(["sales_rep_id", "sales_rep_first_name", "sales_rep_last_name", "product_sold_price", "price", "product_quantity"])
+                     .withColumn("per_product_profit", FT.col("product_sold_price") - FT.col("price")).withColumn("total_profit", FT.col("per_product_profit") * FT.col("product_quantity")).groupBy("sales_rep_id", "sales_rep_first_name", "sales_rep_last_name").sum("total_profit").orderBy(FT.col("sum(total_profit)").desc()).first())
     exp_first = exp_results["sales_rep_first_name"]
     exp_last = exp_results["sales_rep_last_name"]
 
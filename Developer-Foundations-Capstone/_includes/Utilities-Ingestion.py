@@ -0,0 +1,138 @@
+# Databricks notebook source
+import re
+from functools import reduce
+from delta.tables import DeltaTable
+
+#############################################
+# Batch parsers - one per year/format
+#############################################
+
+# The same layout students are given in Exercise #2.A
+batch_fixed_width_column_defs = {
+  "submitted_at": (1, 15),
+  "order_id": (16, 40),
+  "customer_id": (56, 40),
+  "sales_rep_id": (96, 40),
+  "sales_rep_ssn": (136, 15),
+  "sales_rep_first_name": (151, 15),
+  "sales_rep_last_name": (166, 15),
+  "sales_rep_address": (181, 40),
+  "sales_rep_city": (221, 20),
+  "sales_rep_state": (241, 2),
+  "sales_rep_zip": (243, 5),
+  "shipping_address_attention": (248, 30),
+  "shipping_address_address": (278, 40),
+  "shipping_address_city": (318, 20),
+  "shipping_address_state": (338, 2),
+  "shipping_address_zip": (340, 5),
+  "product_id": (345, 40),
+  "product_quantity": (385, 5),
+  "product_sold_price": (390, 20)
+}
+
+batch_columns = BI.list(batch_fixed_width_column_defs.keys())
+
+# Trims every value, converts empty & "null" strings to the SQL value null
+# and adds the ingest meta data, conforming to the unified batch schema
+def normalize_batch(df):
+  def clean(column):
+    value = FT.trim(FT.col(column))
+    return FT.when((value == "") | (value == "null"), None).otherwise(value).alias(column)
+
+  return (df.select([clean(c) for c in batch_columns])
+            .withColumn("ingest_file_name", FT.input_file_name())
+            .withColumn("ingested_at", FT.current_timestamp()))
+
+# 2017: fixed-width text file, one record per line
+def parse_fixed_width_batch(path):
+  raw = spark.read.text(path)
+  df = raw.select([FT.substring("value", start, length).alias(name) for name, (start, length) in batch_fixed_width_column_defs.items()])
+  return normalize_batch(df)
+
+# 2018 & 2019: delimited with a header; 2019 uses camelCase column names
+def parse_delimited_batch(path, sep):
+  raw = spark.read.csv(path, sep=sep, header=True, nullValue="null")
+  df = raw.toDF(*[re.sub(r"(?<!^)(?=[A-Z])", "_", c).lower() for c in raw.columns])
+  return normalize_batch(df)
+
+# Picks the parser from the extension and, for delimited files, the header line
+def parse_batch_file(path):
+  if path.endswith(".txt"):
+    return parse_fixed_width_batch(path)
+
+  header = dbutils.fs.head(path, 4096).split("\n")[0]
+  return parse_delimited_batch(path, "\t" if "\t" in header else ",")
+
+#############################################
+# Incremental, run-once ingestion
+#############################################
+
+# Treats the batch directory as a file stream: only files not yet recorded in the
+# checkpoint are parsed, max_files_per_trigger at a time, and the query stops once
+# the backlog is drained. Only the file listing is streamed (the binaryFile source
+# does not read content unless selected), each file is then parsed by its batch parser.
+def ingest_batch_orders(source_dir=batch_dir, target_path=batch_target_path, checkpoint_path=batch_checkpoint_path, max_files_per_trigger=1, timeout=60*60):
+  results = {"batches": 0, "files": [], "records": 0}
+
+  # Keyed by the checkpoint's query id, see checkpoint_query_id()
+  def txn_app_id():
+    return f"ingest_batch_orders.{checkpoint_query_id(checkpoint_path)}"
+
+  def last_version():
+    try: return DeltaTable.forPath(spark, target_path).history(1).first()["version"]
+    except Exception: return None # Not yet created
+
+  def process_batch(batch_df, batch_id):
+    paths = sorted([r["path"] for r in batch_df.select("path").collect()])
+    if BI.len(paths) == 0: return
+
+    df = reduce(lambda a, b: a.unionByName(b), [parse_batch_file(p) for p in paths])
+
+    # txnAppId/txnVersion make the append idempotent should a batch be replayed
+    before = last_version()
+    (df.write.format("delta").mode("append")
+       .option("txnAppId", txn_app_id())
+       .option("txnVersion", batch_id)
+       .save(target_path))
+
+    results["batches"] += 1
+    results["files"].extend(paths)
+
+    # Read the row count from the commit's metrics rather than re-scanning the table;
+    # a replayed batch is skipped without a commit and so adds no records
+    commit = DeltaTable.forPath(spark, target_path).history(1).first()
+    if commit["version"] != before:
+      results["records"] += int(commit["operationMetrics"].get("numOutputRows", 0))
+
+  files = (spark.readStream
+                .format("binaryFile")
+                .option("maxFilesPerTrigger", max_files_per_trigger)
+                .load(source_dir)
+                .select("path"))
+
+  writer = (files.writeStream
+                 .foreachBatch(process_batch)
+                 .option("checkpointLocation", checkpoint_path)
+                 .queryName("batch_orders"))
+
+  try:
+    query = writer.trigger(availableNow=True).start()
+  except TypeError:
+    # Prior to Spark 3.3 there is no availableNow and once=True ignores maxFilesPerTrigger, so
+    # run bounded micro-batches until a trigger finds no new files, then stop the query
+    query = writer.trigger(processingTime="0 seconds").start()
+
+    def idle():
+      if not query.isActive: return True
+      status = query.status
+      return query.lastProgress is not None and not status["isDataAvailable"] and not status["isTriggerActive"]
+
+    stream_events.wait_until(idle, timeout, f'the stream "{query.name}" to drain its backlog')
+    query.stop()
+
+  query.awaitTermination()
+
+  print(f"""Ingested {BI.len(results["files"])} new file(s), {results["records"]:,d} records in {results["batches"]} batch(es).""")
+  return results
+
+None # Suppress output
@@ -0,0 +1,473 @@
+# Databricks notebook source
+from delta.tables import DeltaTable
+
+#############################################
+# Versioned dimension cache
+#############################################
+
+class PinnedDimension(object):
+  __slots__ = ("table_name", "version", "df", "rows", "lookups")
+
+  def __init__(self, table_name, version, df, rows):
+    self.table_name = table_name
+    self.version = version
+    self.df = df
+    self.rows = rows
+    self.lookups = dict()
+
+# Pins small Delta tables (products, sales_reps) in memory, keyed by table version. The
+# version is read from the Delta log, so checking it costs no scan; a new commit re-pins
+# the table on the next call. Pinned tables are local relations whose exact size lets the
+# planner choose a broadcast hash join without hints, and lookup() ships a key -> row map
+# to the executors once per version.
+class DimensionCache(object):
+  def __init__(self, max_rows:int=100000):
+    self.dimensions = dict()
+    self.max_rows = max_rows
+
+  def version(self, table_name:str) -> int:
+    return DeltaTable.forName(spark, table_name).history(1).first()["version"]
+
+  def table(self, table_name:str):
+    return self._current(table_name).df
+
+  # A broadcast dict of key -> Row, for lookups inside UDFs and RDD functions
+  def lookup(self, table_name:str, key:str):
+    dim = self._current(table_name)
+    if key not in dim.lookups:
+      dim.lookups[key] = sc.broadcast({r[key]: r for r in dim.rows})
+    return dim.lookups[key]
+
+  def invalidate(self, table_name:str=None):
+    for name in ([table_name] if table_name else BI.list(self.dimensions.keys())):
+      dim = self.dimensions.pop(name, None)
+      if dim is not None: self._unpin(dim)
+
+  def _current(self, table_name):
+    version = self.version(table_name)
+    dim = self.dimensions.get(table_name)
+    if dim is None or dim.version != version:
+      if dim is not None: self._unpin(dim)
+      dim = self._pin(table_name, version)
+      self.dimensions[table_name] = dim
+    return dim
+
+  def _pin(self, table_name, version):
+    source = spark.sql(f"SELECT * FROM {table_name} VERSION AS OF {version}")
+    rows = source.limit(self.max_rows+1).collect()
+    if BI.len(rows) > self.max_rows:
+      raise ValueError(f"The table {table_name} has more than {self.max_rows:,d} rows and is too large to pin as a dimension")
+    return PinnedDimension(table_name, version, spark.createDataFrame(rows, source.schema), rows)
+
+  def _unpin(self, dim):
+    for lookup in dim.lookups.values():
+      lookup.unpersist()
+    dim.lookups.clear()
+
+# Keep the pinned tables when a setup notebook is re-run
+try: dimension_cache
+except NameError: dimension_cache = DimensionCache()
+
+#############################################
+# Star-join views
+#############################################
+
+# Each table's key into the table it joins to, the fact tables first: a column found in
+# more than one table (e.g. the ingest columns) is read from the first table listed here
+star_tables = {
+  orders_table:     None,
+  line_items_table: ("order_id", orders_table),
+  sales_reps_table: ("sales_rep_id", orders_table),
+  products_table:   ("product_id", line_items_table),
+}
+star_dimensions = [sales_reps_table, products_table]
+
+# Joined relations cached by star_view(cache=True), by the view's shape: (versions, df)
+star_view_cache = dict()
+
+def star_columns(table_name):
+  return dimension_cache.table(table_name).columns if table_name in star_dimensions else spark.read.table(table_name).columns
+
+# Joins only the tables that hold the requested columns and filters (plus any table needed
+# to connect them), each pruned to those columns and its keys. filters maps a column to a
+# value, or a list of values, and is applied to the owning table before the joins, so that
+# e.g. {"color": "green"} shrinks products before it meets line_items. Dimensions come from
+# the dimension_cache and are therefore broadcast. where is an optional Column applied
+# after the joins. With cache=True the result is persisted and shared by every call of the
+# same shape until a table's version changes.
+def star_view(columns:List[str]=None, filters:dict=None, where=None, cache:bool=False):
+  filters = filters or {}
+  owners = dict()
+  for table in star_tables:
+    for c in star_columns(table): owners.setdefault(c, table)
+
+  columns = columns or BI.list(owners.keys())
+  unknown = [c for c in BI.list(columns) + BI.list(filters.keys()) if c not in owners]
+  if unknown: raise ValueError(f"Unknown star schema column(s): {unknown}")
+
+  needed = set(owners[c] for c in BI.list(columns) + BI.list(filters.keys()))
+  if sales_reps_table in needed: needed.add(orders_table)
+  if products_table in needed and orders_table in needed: needed.add(line_items_table)
+
+  key = (tuple(columns), tuple(BI.sorted((c, str(v)) for c, v in filters.items())), str(where))
+  versions = {t: dimension_cache.version(t) for t in needed}
+  if cache and key in star_view_cache and star_view_cache[key][0] == versions:
+    return star_view_cache[key][1]
+
+  def relation(table):
+    df = dimension_cache.table(table) if table in star_dimensions else spark.read.table(table)
+    keys = set([star_tables[table][0]] if star_tables[table] else []) | set(star_tables[t][0] for t in needed if star_tables[t] and star_tables[t][1] == table)
+    for c, v in filters.items():
+      if owners[c] == table: df = df.filter(FT.col(c).isin(v) if isinstance(v, (list, tuple, set)) else FT.col(c) == v)
+    return df.select(*BI.sorted(keys), *[c for c in columns if owners[c] == table and c not in keys])
+
+  joined = None
+  for table in [t for t in star_tables if t in needed]:
+    if joined is None: joined = relation(table)
+    else: joined = joined.join(relation(table), star_tables[table][0])
+
+  if where is not None: joined = joined.filter(where)
+  joined = joined.select(*columns)
+
+  if cache:
+    if key in star_view_cache: star_view_cache[key][1].unpersist()
+    joined = joined.persist()
+    star_view_cache[key] = (versions, joined)
+  return joined
+
+#############################################
+# Incrementally maintained aggregates
+#############################################
+
+# One measure of a MaterializedAggregate: the column to store, the expression it
+# aggregates and how partial results combine, one of "sum", "min" or "max"
+# (counts are sums of FT.lit(1), averages are derived from a sum and a count).
+class Measure(object):
+  __slots__ = ("name", "expression", "kind")
+  def __init__(self, name:str, expression, kind:str="sum"):
+    self.name = name
+    self.expression = expression
+    self.kind = kind
+
+  def aggregate(self):
+    return {"sum": FT.sum, "min": FT.min, "max": FT.max}[self.kind](self.expression).alias(self.name)
+
+  def combine(self):
+    t, s = f"t.`{self.name}`", f"s.`{self.name}`"
+    if self.kind == "sum": return f"coalesce({t}, 0) + coalesce({s}, 0)"
+    return f"{'least' if self.kind == 'min' else 'greatest'}({t}, {s})"
+
+def change_data_feed_enabled(table_name) -> bool:
+  properties = {r["key"]: r["value"] for r in spark.sql(f"SHOW TBLPROPERTIES {table_name}").collect()}
+  return properties.get("delta.enableChangeDataFeed") == "true"
+
+# Enables the change data feed that incremental refreshes read. It is a setup step of its own,
+# run while nothing else writes to the tables, as the property change is a commit of its own.
+def enable_change_data_feed(table_names:List[str]=None):
+  for table_name in table_names or [orders_table, line_items_table]:
+    if not change_data_feed_enabled(table_name):
+      spark.sql(f"ALTER TABLE {table_name} SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+      print(f"Enabled the change data feed of {table_name}")
+
+# An aggregate over the star schema kept in the Delta table table_name. It is declared by
+#   facts:      the fact tables it reads, e.g. [orders_table, line_items_table]
+#   join:       a function from a dict of fact DataFrames (by table name) and the pinned
+#               dimension_cache to the joined (and filtered) rows to aggregate
+#   keys:       the group-by columns, none for a single global row
+#   measures:   a list of Measure
+#   dimensions: the dimension tables join() reads; when one changes the aggregate is rebuilt
+#   finalize:   an optional function applied by read(), e.g. to derive an average
+#
+# refresh() reads only the fact rows committed since the last refresh from the Delta change
+# feed, which must be enabled on the facts beforehand (see enable_change_data_feed), and joins each fact's new rows with the other
+# facts as of the appropriate version: the change of F1 x F2 is dF1 x F2(old) + F1(new) x dF2.
+# The partial aggregates are merged in; the fact & dimension versions are recorded in the
+# MERGE's own commit (userMetadata) so that a refresh is never applied twice.
+class MaterializedAggregate(object):
+  def __init__(self, table_name:str, facts:List[str], join, keys:List[str], measures:List[Measure], dimensions:List[str]=None, finalize=None):
+    self.table_name = table_name
+    self.facts = facts
+    self.join = join
+    self.keys = keys or ["_all"]
+    self.global_row = not keys
+    self.measures = measures
+    self.dimensions = dimensions or []
+    self.finalize = finalize
+
+  def read(self):
+    df = spark.read.table(self.table_name)
+    if self.global_row: df = df.drop("_all")
+    return self.finalize(df) if self.finalize else df
+
+  # The versions the aggregate reflects, when it was refreshed & how many commits it is behind
+  def freshness(self) -> dict:
+    state = self._state()
+    if state is None: return {"table": self.table_name, "refreshed_at": None}
+    behind = {t: dimension_cache.version(t) - v for t, v in state["versions"].items()}
+    return {"table": self.table_name, "refreshed_at": state["refreshed_at"], "versions": state["versions"], "commits_behind": behind}
+
+  def refresh(self, full:bool=False) -> str:
+    state = None if full else self._state()
+    current = {t: dimension_cache.version(t) for t in self.facts + self.dimensions}
+
+    if state is None or BI.any(state["versions"].get(d) != current[d] for d in self.dimensions):
+      return self._full_refresh()
+    if BI.all(state["versions"][f] == current[f] for f in self.facts):
+      return "unchanged"
+
+    disabled = [f for f in self.facts if state["versions"][f] != current[f] and not change_data_feed_enabled(f)]
+    if disabled:
+      print(f"""The change data feed is off for {", ".join(disabled)}, rebuilding {self.table_name}; see enable_change_data_feed()""")
+      return self._full_refresh()
+
+    try:
+      changes = {f: self._changes(f, state["versions"][f], current[f]) for f in self.facts if state["versions"][f] != current[f]}
+    except Exception:
+      return self._full_refresh() # The change feed does not cover the versions (e.g. it was never enabled)
+    if BI.any(c is None for c in changes.values()):
+      return self._full_refresh() # Rows were updated or deleted, only appends are maintained
+
+    partials = []
+    for i, fact in enumerate(self.facts):
+      if fact not in changes: continue
+      dfs = {f: self._snapshot(f, current[f]) for f in self.facts[:i]}
+      dfs[fact] = changes[fact]
+      dfs.update({f: self._snapshot(f, state["versions"][f]) for f in self.facts[i+1:]})
+      partials.append(self._aggregate(dfs))
+
+    delta = partials[0]
+    for p in partials[1:]: delta = delta.unionByName(p)
+    delta = delta.groupBy(*self.keys).agg(*[Measure(m.name, FT.col(m.name), m.kind).aggregate() for m in self.measures])
+
+    matched = " AND ".join([f"t.`{k}` <=> s.`{k}`" for k in self.keys])
+    self._merge_with_metadata(current, lambda: (DeltaTable.forName(spark, self.table_name).alias("t")
+                                                  .merge(delta.alias("s"), matched)
+                                                  .whenMatchedUpdate(set={m.name: m.combine() for m in self.measures})
+                                                  .whenNotMatchedInsertAll()
+                                                  .execute()))
+    return "incremental"
+
+  def _full_refresh(self):
+    current = {t: dimension_cache.version(t) for t in self.facts + self.dimensions}
+    df = self._aggregate({f: self._snapshot(f, current[f]) for f in self.facts})
+    (df.write.format("delta").mode("overwrite")
+       .option("overwriteSchema", "true")
+       .option("userMetadata", self._metadata(current))
+       .saveAsTable(self.table_name))
+    return "full"
+
+  def _aggregate(self, dfs):
+    df = self.join(dfs, dimension_cache)
+    if self.global_row: df = df.withColumn("_all", FT.lit(True))
+    return df.groupBy(*self.keys).agg(*[m.aggregate() for m in self.measures])
+
+  def _snapshot(self, table_name, version):
+    return spark.sql(f"SELECT * FROM {table_name} VERSION AS OF {version}")
+
+  # Rows inserted in (from_version, to_version], or None if any were updated or deleted
+  def _changes(self, table_name, from_version, to_version):
+    changes = (spark.read.format("delta")
+                    .option("readChangeFeed", "true")
+                    .option("startingVersion", from_version+1)
+                    .option("endingVersion", to_version)
+                    .table(table_name))
+    if changes.filter(FT.col("_change_type") != "insert").limit(1).count() > 0: return None
+    return changes.drop("_change_type", "_commit_version", "_commit_timestamp")
+
+  def _metadata(self, versions):
+    import json, time
+    return json.dumps({"versions": versions, "refreshed_at": time.time()})
+
+  # A MERGE takes no writer options, so its userMetadata is set in the session conf, which
+  # every commit of the session reads until it is restored. Streams commit from their own
+  # threads and would be tagged too, so the MERGE is refused while any is active.
+  def _merge_with_metadata(self, versions, merge):
+    key = "spark.databricks.delta.commitInfo.userMetadata"
+    if spark.streams.active: raise Exception(f"Stop the active streams before refreshing {self.table_name}")
+    previous = spark.conf.get(key, None)
+    spark.conf.set(key, self._metadata(versions))
+    try: merge()
+    finally:
+      if previous is None: spark.conf.unset(key)
+      else: spark.conf.set(key, previous)
+
+  def _state(self):
+    import json
+    try: history = DeltaTable.forName(spark, self.table_name).history(20).select("userMetadata").collect()
+    except Exception: return None # The aggregate has not been built yet
+    for commit in history:
+      if commit["userMetadata"]:
+        state = json.loads(commit["userMetadata"])
+        if "versions" in state: return state
+    return None
+
+#############################################
+# Mergeable sketches
+#############################################
+
+# Persists, per combination of the key columns (e.g. date, state, color), sketches that
+# merge across keys and time ranges without the raw rows:
+#   <name>_hll:       HyperLogLog registers of distinct_column, the rows (register, rho) of
+#                     the registers set, merged by max
+#   <name>_quantiles: a relative-error quantile sketch (DDSketch) of value_column, the
+#                     rows (bucket, count) of log-scale buckets, merged by sum; unlike a
+#                     t-digest it merges exactly with plain SQL aggregates
+#   <name>_moments:   the count, sum, min & max of value_column, for exact averages & ranges
+# update() appends the partial sketches of any batch, which every read merges; with a
+# batch_id the append is keyed by txnAppId/txnVersion so that a replayed micro-batch (see
+# foreach_batch()) is skipped, and overwrite=True replaces the store, e.g. for a rebuild.
+# compact() merges the appended rows. Reads take an optional where (a SQL predicate on the
+# keys) and group_by.
+class SketchStore(object):
+  def __init__(self, name:str, keys:List[str], distinct_column:str=None, value_column:str=None, precision:int=12, relative_accuracy:float=0.01):
+    import math
+    self.name = name
+    self.keys = keys
+    self.distinct_column = distinct_column
+    self.value_column = value_column
+    self.precision = precision
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+
+  def update(self, df, batch_id:int=None, app_id:str=None, overwrite:bool=False):
+    write = lambda table_name, sketch: self._write(table_name, sketch, batch_id, app_id, overwrite)
+
+    if self.distinct_column:
+      h = FT.xxhash64(self.distinct_column)
+      w = FT.shiftRightUnsigned(h, self.precision)
+      # rho: the position of the leftmost 1-bit of the remaining 64 - precision bits
+      rho = FT.when(w == 0, 64 - self.precision + 1).otherwise(64 - self.precision - FT.length(FT.bin(w)) + 1)
+      registers = (df.filter(FT.col(self.distinct_column).isNotNull())
+                     .select(*self.keys, h.bitwiseAND(2**self.precision - 1).cast("int").alias("register"), rho.cast("int").alias("rho"))
+                     .groupBy(*self.keys, "register").agg(FT.max("rho").alias("rho")))
+      write(f"{self.name}_hll", registers)
+
+    if self.value_column:
+      values = df.filter(FT.col(self.value_column).isNotNull())
+      value = FT.col(self.value_column).cast("double")
+      bucket = FT.when(value <= 0, FT.lit(-2**31)).otherwise(FT.ceil(FT.log(value) / self.log_gamma)).cast("int")
+      buckets = values.groupBy(*self.keys, bucket.alias("bucket")).agg(FT.count(FT.lit(1)).alias("count"))
+      write(f"{self.name}_quantiles", buckets)
+
+      moments = values.groupBy(*self.keys).agg(FT.count(FT.lit(1)).alias("count"), FT.sum(value).alias("sum"), FT.min(value).alias("min"), FT.max(value).alias("max"))
+      write(f"{self.name}_moments", moments)
+
+  # For writeStream.foreachBatch(store.foreach_batch(checkpoint_path)); the appends are keyed
+  # by the checkpoint's query id, so a query restarted from a new checkpoint starts over
+  def foreach_batch(self, checkpoint_path:str):
+    return lambda batch_df, batch_id: self.update(batch_df, batch_id, f"{self.name}.{checkpoint_query_id(checkpoint_path)}")
+
+  # Merges the rows appended by update() into one row per key (and register or bucket)
+  def compact(self):
+    tables = {
+      f"{self.name}_hll": (self.keys + ["register"], [Measure("rho", FT.col("rho"), "max")]),
+      f"{self.name}_quantiles": (self.keys + ["bucket"], [Measure("count", FT.col("count"), "sum")]),
+      f"{self.name}_moments": (self.keys, [Measure(n, FT.col(n), k) for n, k in [("count", "sum"), ("sum", "sum"), ("min", "min"), ("max", "max")]]),
+    }
+    for table_name, (keys, measures) in tables.items():
+      if not table_exists(table_name): continue
+      merged = spark.read.table(table_name).groupBy(*keys).agg(*[m.aggregate() for m in measures])
+      merged.write.format("delta").mode("overwrite").saveAsTable(table_name)
+
+  # Estimated distinct count of distinct_column, an int or, with group_by, a DataFrame
+  def distinct_count(self, where:str=None, group_by:List[str]=None):
+    group_by = group_by or []
+    m = 2**self.precision
+    alpha = 0.7213 / (1 + 1.079 / m)
+    registers = self._read(f"{self.name}_hll", where).groupBy(*group_by, "register").agg(FT.max("rho").alias("rho"))
+    stats = registers.groupBy(*group_by).agg(FT.count(FT.lit(1)).alias("present"), FT.sum(FT.pow(2.0, -FT.col("rho"))).alias("z"))
+    zeros = FT.lit(m) - FT.col("present")
+    raw = FT.lit(alpha * m * m) / (zeros + FT.col("z"))
+    # Linear counting corrects the small range, while registers are still empty
+    estimate = FT.when((raw <= 2.5 * m) & (zeros > 0), FT.lit(m) * FT.log(FT.lit(m) / zeros)).otherwise(raw)
+    result = stats.select(*group_by, FT.round(estimate).cast("long").alias("approx_distinct"))
+    if group_by: return result
+    row = result.first()
+    return row[0] if row else 0
+
+  # Estimated percentiles (0-100) of value_column, within the store's relative accuracy
+  def quantiles(self, percentiles=(50, 90, 99), where:str=None) -> dict:
+    buckets = self._read(f"{self.name}_quantiles", where).groupBy("bucket").agg(FT.sum("count").alias("count")).orderBy("bucket").collect()
+    total = BI.sum(b["count"] for b in buckets)
+    results = dict()
+    for p in percentiles:
+      rank, seen = p / 100 * (total - 1), 0
+      for b in buckets:
+        seen += b["count"]
+        if seen > rank:
+          results[p] = 0.0 if b["bucket"] == -2**31 else 2 * self.gamma ** b["bucket"] / (self.gamma + 1)
+          break
+      else: results[p] = None
+    return results
+
+  # Exact count, sum, min, max & avg of value_column
+  def summary(self, where:str=None, group_by:List[str]=None):
+    group_by = group_by or []
+    result = (self._read(f"{self.name}_moments", where).groupBy(*group_by)
+                  .agg(FT.sum("count").alias("count"), FT.sum("sum").alias("sum"), FT.min("min").alias("min"), FT.max("max").alias("max"))
+                  .withColumn("avg", FT.col("sum") / FT.col("count")))
+    return result if group_by else result.first().asDict()
+
+  def _read(self, table_name, where):
+    df = spark.read.table(table_name)
+    return df.filter(where) if where else df
+
+  def _write(self, table_name, df, batch_id, app_id, overwrite):
+    writer = df.write.format("delta").mode("overwrite" if overwrite else "append")
+    if batch_id is not None:
+      writer = writer.option("txnAppId", f"{app_id or self.name}.{table_name}").option("txnVersion", batch_id)
+    writer.saveAsTable(table_name)
+
+#############################################
+# The Exercise #6 business questions
+#############################################
+
+def star_join(dfs, dims):
+  return (dfs[orders_table].join(dims.table(sales_reps_table), "sales_rep_id")
+                           .join(dfs[line_items_table], "order_id")
+                           .join(dims.table(products_table), "product_id"))
+
+business_aggregates = {
+  # Question #1: the number of orders shipped to each state
+  "question_1": MaterializedAggregate("question_1_aggregate", [orders_table],
+    join=lambda dfs, dims: dfs[orders_table],
+    keys=["shipping_address_state"],
+    measures=[Measure("count", FT.lit(1))],
+    finalize=lambda df: df.orderBy(FT.col("count").desc())),
+
+  # Question #2: the price statistics of green products sold to NC by reps with a dashed SSN
+  "question_2": MaterializedAggregate("question_2_aggregate", [orders_table, line_items_table],
+    join=lambda dfs, dims: (star_join(dfs, dims).filter(FT.col("shipping_address_state") == "NC")
+                                                .filter(FT.col("_error_ssn_format") == True)
+                                                .filter(FT.col("color") == "green")),
+    keys=[],
+    measures=[Measure("sum(product_sold_price)", FT.col("product_sold_price")),
+              Measure("count(product_sold_price)", FT.col("product_sold_price").isNotNull().cast("long")),
+              Measure("min(product_sold_price)", FT.col("product_sold_price"), "min"),
+              Measure("max(product_sold_price)", FT.col("product_sold_price"), "max")],
+    dimensions=[sales_reps_table, products_table],
+    finalize=lambda df: df.select((FT.col("`sum(product_sold_price)`") / FT.col("`count(product_sold_price)`")).alias("avg(product_sold_price)"),
+                                  "`min(product_sold_price)`", "`max(product_sold_price)`")),
+
+  # Question #3: the sales rep with the highest total profit
+  "question_3": MaterializedAggregate("question_3_aggregate", [orders_table, line_items_table],
+    join=lambda dfs, dims: star_join(dfs, dims).withColumn("total_profit", (FT.col("product_sold_price") - FT.col("price")) * FT.col("product_quantity")),
+    keys=["sales_rep_id", "sales_rep_first_name", "sales_rep_last_name"],
+    measures=[Measure("sum(total_profit)", FT.col("total_profit"))],
+    dimensions=[sales_reps_table, products_table],
+    finalize=lambda df: df.orderBy(FT.col("`sum(total_profit)`").desc())),
+}
+
+# Brings every business aggregate up to date, returning how each was refreshed
+def refresh_business_aggregates(full=False) -> dict:
+  return {name: aggregate.refresh(full) for name, aggregate in business_aggregates.items()}
+
+# Sketches of the sold line items by the Exercise #6 filter columns, e.g.
+# price_sketches.summary("shipping_address_state = 'NC' AND color = 'green' AND _error_ssn_format")
+price_sketches = SketchStore("price_sketches", keys=["submitted_yyyy_mm", "shipping_address_state", "color", "_error_ssn_format"],
+                             distinct_column="customer_id", value_column="product_sold_price")
+
+def build_price_sketches():
+  price_sketches.update(star_view(price_sketches.keys + ["customer_id", "product_sold_price"]), overwrite=True)
+
+None # Suppress output
@@ -0,0 +1,528 @@
+# Databricks notebook source
+import math
+from functools import reduce
+from pyspark import StorageLevel
+from pyspark.sql.utils import ParseException
+from delta.tables import DeltaTable
+
+ingest_columns = ["ingest_file_name", "ingested_at"]
+
+# Returns the number of rows written by the table's most recent commit,
+# read from the Delta log instead of re-scanning the table
+def last_commit_row_count(table_name):
+  metrics = DeltaTable.forName(spark, table_name).history(1).first()["operationMetrics"]
+  return int(metrics.get("numOutputRows", 0))
+
+# The version of the table's most recent commit, None if the table does not exist yet
+def last_commit_version(table_name):
+  try: return DeltaTable.forName(spark, table_name).history(1).first()["version"]
+  except Exception: return None
+
+#############################################
+# Hash-keyed deduplication
+#############################################
+
+# A compact hash over the key columns; 64 bits is a single xxhash64, 128 bits
+# pairs it with a second xxhash64 over a salted input
+def row_hash(keys:List[str], bits:int=64):
+  if bits == 64: return FT.xxhash64(*keys)
+  elif bits == 128: return FT.struct(FT.xxhash64(*keys).alias("h1"), FT.xxhash64(FT.lit("#128"), *keys).alias("h2"))
+  else: raise ValueError(f"Expected 64 or 128 bits, found {bits}")
+
+# Deduplicates df on the key columns (all columns by default) while shuffling only
+# a row hash and a row id: the distinct step groups (hash, id) pairs, the surviving
+# ids then fetch the full rows with a (shuffle) semi-join. broadcast_survivors=True
+# broadcasts the ids instead, only worthwhile when few rows survive.
+#
+# With verify=True, rows whose hash matches a survivor but whose keys differ (a hash
+# collision) are detected exactly and kept, deduplicated on their actual keys. Only the
+# rows of hash groups with more than one row have their keys compared, joined on the hash.
+#
+# Row ids come from monotonically_increasing_id() so df must be deterministic when
+# re-evaluated, e.g. a table scan or a persisted DataFrame.
+def hash_dedup(df, keys:List[str]=None, bits:int=64, verify:bool=False, broadcast_survivors:bool=False):
+  keys = keys or df.columns
+  ided = df.withColumn("_row_id", FT.monotonically_increasing_id()).withColumn("_row_hash", row_hash(keys, bits))
+
+  groups = ided.select("_row_hash", "_row_id").groupBy("_row_hash").agg(FT.min("_row_id").alias("_row_id"), FT.count(FT.lit(1)).alias("_rows"))
+  survivors = groups.select("_row_id")
+
+  if verify:
+    shared = ided.join(groups.filter(FT.col("_rows") > 1).select("_row_hash"), "_row_hash", "left_semi").select("_row_hash", "_row_id", *keys)
+    reps = shared.join(survivors, "_row_id", "left_semi").select("_row_hash", *[FT.col(k).alias(f"_rep_{k}") for k in keys])
+    same_keys = reduce(lambda a, b: a & b, [FT.col(k).eqNullSafe(FT.col(f"_rep_{k}")) for k in keys])
+    collided = (shared.join(reps, "_row_hash")
+                      .filter(~same_keys)
+                      .groupBy(*keys).agg(FT.min("_row_id").alias("_row_id")))
+    survivors = survivors.union(collided.select("_row_id"))
+
+  if broadcast_survivors: survivors = FT.broadcast(survivors)
+
+  return ided.join(survivors, "_row_id", "left_semi").drop("_row_id", "_row_hash")
+
+#############################################
+# Incremental dimension maintenance
+#############################################
+
+def table_exists(table_name):
+  return BI.len(BI.list(BI.filter(lambda t: t.name == table_name, spark.catalog.listTables()))) == 1
+
+# Upserts the incoming batch into a dimension table keyed by its natural key(s),
+# e.g. ["sales_rep_id"] or ["product_id"]. Only new keys are inserted and only rows
+# whose compared columns changed are updated: a null-safe comparison of those columns
+# skips no-op updates, leaving untouched files and caches intact.
+# The ingest columns are not compared by default. A missing table is created.
+# Returns the number of inserted, updated and unchanged rows.
+def upsert_dimension(table_name, updates_df, keys:List[str], ignore_columns:List[str]=ingest_columns) -> dict:
+  updates_df = updates_df.dropDuplicates(keys)
+
+  if not table_exists(table_name):
+    updates_df.write.format("delta").saveAsTable(table_name)
+    inserted = last_commit_row_count(table_name)
+    print(f"Created {table_name} with {inserted:,d} records")
+    return {"inserted": inserted, "updated": 0, "unchanged": 0}
+
+  compared = [c for c in updates_df.columns if c not in keys and c not in ignore_columns]
+  matched = " AND ".join([f"t.`{k}` <=> s.`{k}`" for k in keys])
+  changed = "NOT ({})".format(" AND ".join([f"t.`{c}` <=> s.`{c}`" for c in compared]))
+
+  (DeltaTable.forName(spark, table_name).alias("t")
+     .merge(updates_df.alias("s"), matched)
+     .whenMatchedUpdateAll(condition=changed if compared else "false")
+     .whenNotMatchedInsertAll()
+     .execute())
+
+  metrics = DeltaTable.forName(spark, table_name).history(1).first()["operationMetrics"]
+  inserted = int(metrics.get("numTargetRowsInserted", 0))
+  updated = int(metrics.get("numTargetRowsUpdated", 0))
+  unchanged = int(metrics.get("numSourceRows", 0)) - inserted - updated
+
+  print(f"Upserted {table_name}: {inserted:,d} inserted, {updated:,d} updated, {unchanged:,d} unchanged")
+  return {"inserted": inserted, "updated": updated, "unchanged": unchanged}
+
+#############################################
+# Single-scan fan-out writer
+#############################################
+
+# One target of fan_out_write()
+#   table:        name of the managed Delta table to (over)write
+#   transform:    function from the shared source DataFrame to the target's rows
+#   dedup:        None for no deduplication, True for a full-row dedup or a list of key columns
+#   columns:      the source columns the transform needs, used to prune the shared intermediate
+#   partition_by: optional list of partition columns
+#   hashed:       dedup with hash_dedup() instead of dropDuplicates(), shuffling only a hash per row
+#   merge_keys:   upsert with upsert_dimension() on these natural keys instead of writing with mode
+class FanOutTarget(object):
+  __slots__ = ("table", "transform", "dedup", "columns", "partition_by", "mode", "hashed", "merge_keys")
+  def __init__(self, table:str, transform, dedup=None, columns:List[str]=None, partition_by:List[str]=None, mode:str="overwrite", hashed:bool=False, merge_keys:List[str]=None):
+    self.table = table
+    self.merge_keys = merge_keys
+    self.transform = transform
+    self.dedup = dedup
+    self.hashed = hashed
+    self.columns = columns
+    self.partition_by = partition_by or []
+    self.mode = mode
+
+  def build(self, df):
+    result = self.transform(df)
+    if not self.dedup: return result
+
+    keys = None if self.dedup is True else self.dedup
+    if self.hashed: return hash_dedup(result, keys)
+    elif keys: return result.dropDuplicates(keys)
+    else: return result.dropDuplicates()
+
+# Writes every target from a single scan of source_df. The source is pruned to the
+# columns the targets need and persisted for the duration of the call only; the first
+# write materializes it and the remaining writes read the persisted copy. The
+# intermediate is always released, even when a write fails.
+# Returns the number of rows committed to each target table (inserted + updated for merges).
+# When txn_app_id & txn_version are specified (e.g. a stream's batch id), every append is
+# committed idempotently per table so that a replayed batch is skipped by Delta.
+def fan_out_write(source_df, targets:List[FanOutTarget], storage_level=StorageLevel.MEMORY_AND_DISK, txn_app_id:str=None, txn_version:int=None) -> dict:
+  if BI.all(t.columns for t in targets):
+    needed = set(c for t in targets for c in t.columns)
+    source_df = source_df.select([c for c in source_df.columns if c in needed])
+
+  shared = source_df.persist(storage_level)
+  counts = dict()
+  try:
+    for target in targets:
+      if target.merge_keys:
+        result = upsert_dimension(target.table, target.build(shared), target.merge_keys)
+        counts[target.table] = result["inserted"] + result["updated"]
+        continue
+      writer = target.build(shared).write.format("delta").mode(target.mode)
+      if target.partition_by: writer = writer.partitionBy(*target.partition_by)
+      if txn_app_id is not None:
+        writer = writer.option("txnAppId", f"{txn_app_id}.{target.table}").option("txnVersion", txn_version)
+      before = last_commit_version(target.table)
+      writer.saveAsTable(target.table)
+      # A replayed batch is skipped without a commit, so it wrote nothing
+      counts[target.table] = last_commit_row_count(target.table) if last_commit_version(target.table) != before else 0
+  finally:
+    shared.unpersist()
+
+  for table, count in counts.items():
+    print(f"Wrote {count:,d} records to {table}")
+  return counts
+
+#############################################
+# Partition layout advisor
+#############################################
+
+# Candidate layouts: (column, granularity) where the granularity of a timestamp
+# column is year, month or day and "value" partitions by the column itself.
+# The derived partition column of each time granularity follows submitted_yyyy_mm.
+time_granularities = {
+  "year":  ("yyyy", "yyyy"),
+  "month": ("yyyy-MM", "yyyy_mm"),
+  "day":   ("yyyy-MM-dd", "yyyy_mm_dd"),
+}
+
+def partition_column_name(column, granularity):
+  if granularity == "value": return column
+  return f"{column.replace('_at', '')}_{time_granularities[granularity][1]}"
+
+def partition_expression(column, granularity):
+  if granularity == "value": return FT.col(column)
+  return FT.date_format(column, time_granularities[granularity][0])
+
+# Equality predicates, by column, of the Exercise #6 business questions against the
+# orders table. Question #2 filters color & SSN format on other tables, so only the
+# shipping state can be pruned in orders; questions #1 & #3 read every order.
+business_query_filters = {
+  "question_1": {},
+  "question_2": {"shipping_address_state": "NC"},
+  "question_3": {},
+}
+
+# Analyzes the row count and estimated bytes of every partition of each candidate
+# layout, including "none", and recommends the layout whose median partition is
+# closest to target_partition_bytes without falling below target_file_bytes.
+# Bytes are estimated from the table's size on disk and its row count. The time
+# column is aggregated once, by day, and rolled up to month and year on the driver.
+def analyze_partition_layouts(table_name=orders_table, time_column="submitted_at", value_columns:List[str]=None,
+                              target_file_bytes=128*1024*1024, target_partition_bytes=1024*1024*1024, query_filters=business_query_filters):
+  import statistics
+
+  value_columns = ["shipping_address_state"] if value_columns is None else value_columns
+  df = spark.read.table(table_name)
+  detail = spark.sql(f"DESCRIBE DETAIL {table_name}").first()
+  total_bytes = detail["sizeInBytes"]
+
+  # Rows per candidate partition value, keyed by (column, granularity)
+  candidates = dict()
+  days = {r["p"]: r["count"] for r in df.groupBy(partition_expression(time_column, "day").alias("p")).count().collect()}
+  candidates[(time_column, "day")] = days
+  for granularity, length in [("month", 7), ("year", 4)]:
+    rolled = dict()
+    for day, count in days.items():
+      key = None if day is None else day[:length]
+      rolled[key] = rolled.get(key, 0) + count
+    candidates[(time_column, granularity)] = rolled
+  for column in value_columns:
+    candidates[(column, "value")] = {r[column]: r["count"] for r in df.groupBy(column).count().collect()}
+
+  total_rows = BI.sum(days.values())
+  bytes_per_row = total_bytes / total_rows if total_rows else 0
+  candidates[(None, "none")] = {None: total_rows}
+
+  layouts = []
+  for (column, granularity), rows in candidates.items():
+    partition_bytes = [count * bytes_per_row for count in rows.values()]
+    median_bytes = statistics.median(partition_bytes) if partition_bytes else 0
+
+    # Fraction of the table each business question reads under this layout
+    pruning = dict()
+    for query, filters in query_filters.items():
+      if column in filters: pruning[query] = rows.get(filters[column], 0) / total_rows if total_rows else 0
+      else: pruning[query] = 1.0
+
+    layouts.append({
+      "column": column,
+      "granularity": granularity,
+      "partitions": BI.len(rows),
+      "min_rows": BI.min(rows.values(), default=0), # An empty table has no partitions
+      "max_rows": BI.max(rows.values(), default=0),
+      "median_bytes": int(median_bytes),
+      "estimated_files": BI.sum(BI.max(1, math.ceil(b / target_file_bytes)) for b in partition_bytes),
+      "fraction_read": pruning,
+      "score": abs(math.log(BI.max(median_bytes, 1) / target_partition_bytes)) + (10 if median_bytes < target_file_bytes and column else 0),
+    })
+
+  layouts.sort(key=lambda l: l["score"])
+
+  print(f"{table_name}: {total_rows:,d} records, {total_bytes:,d} bytes in {detail['numFiles']:,d} files")
+  for l in layouts:
+    read = ", ".join(f"{q}={f:.0%}" for q, f in l["fraction_read"].items())
+    print(f"""  {l["granularity"]:>5} {l["column"] or "":<24} {l["partitions"]:>6,d} partitions, median {l["median_bytes"]:>14,d} bytes, ~{l["estimated_files"]:,d} files, reads: {read}""")
+  print(f"""Recommended: {layouts[0]["granularity"]} {layouts[0]["column"] or ""}""")
+
+  return layouts
+
+# Rewrites the table into the given layout in a single Delta transaction (readers see
+# either the old or the new layout). Time granularities add their derived partition
+# column, e.g. submitted_yyyy for year; "none" removes partitioning. Files are capped
+# at roughly target_file_bytes using the table's current bytes per record.
+def rewrite_partition_layout(table_name, column, granularity, target_file_bytes=128*1024*1024):
+  detail = spark.sql(f"DESCRIBE DETAIL {table_name}").first()
+  df = spark.read.table(table_name)
+  total_rows = df.count()
+  max_records = BI.max(1, int(target_file_bytes / (detail["sizeInBytes"] / total_rows))) if total_rows else 1
+
+  writer_df = df
+  partition_by = []
+  if granularity != "none":
+    partition_column = partition_column_name(column, granularity)
+    if partition_column not in df.columns: writer_df = df.withColumn(partition_column, partition_expression(column, granularity))
+    partition_by = [partition_column]
+    writer_df = writer_df.repartition(partition_column)
+  else:
+    writer_df = writer_df.coalesce(BI.max(1, math.ceil(total_rows / max_records)))
+
+  writer = (writer_df.write.format("delta").mode("overwrite")
+                     .option("overwriteSchema", "true")
+                     .option("maxRecordsPerFile", max_records))
+  if partition_by: writer = writer.partitionBy(*partition_by)
+  writer.saveAsTable(table_name)
+
+  print(f"""Rewrote {table_name} partitioned by {partition_by or "nothing"}""")
+
+#############################################
+# File-level data-skipping index
+#############################################
+
+# The index of a table is itself a Delta table stored outside the table's directory, under
+# <working_dir>/skipping_index/<table>, so that listings of the table (e.g. of its
+# partitions) are unchanged. It has one row per data file: the file, then <column>__min, __max & __nulls for every
+# indexed column and, for bloom columns, <column>__bloom, the bit positions set by the
+# file's values. Nested columns such as geo.state are named geo_state.
+skipping_index_bloom_bits = 4096
+skipping_index_bloom_hashes = 3
+
+def skipping_index_path(table_name):
+  return f"{working_dir}/skipping_index/{table_name}"
+
+# The most recent prune_with_skipping_index() report, by table name
+skipping_index_reports = dict()
+
+# The bloom filter bits of a value: one non-negative xxhash64 modulo bits per seed
+def bloom_positions(column, bits=skipping_index_bloom_bits, hashes=skipping_index_bloom_hashes):
+  return FT.array(*[(FT.xxhash64(column, FT.lit(i)) % bits + bits) % bits for i in range(hashes)])
+
+def index_column_name(column):
+  return column.replace(".", "_")
+
+def file_summaries(df, columns:List[str], bloom_columns:List[str]):
+  aggregates = []
+  for c in columns:
+    n = index_column_name(c)
+    aggregates += [FT.min(c).alias(f"{n}__min"), FT.max(c).alias(f"{n}__max"), FT.count(FT.when(FT.col(c).isNull(), 1)).alias(f"{n}__nulls")]
+  for c in bloom_columns:
+    aggregates.append(FT.array_distinct(FT.flatten(FT.collect_set(bloom_positions(FT.col(c))))).alias(f"{index_column_name(c)}__bloom"))
+  return df.withColumn("file", FT.input_file_name()).groupBy("file").agg(FT.count(FT.lit(1)).alias("rows"), *aggregates)
+
+# Builds or brings the index up to date with the table's current files: only files added
+# since the last update are summarized (read directly, with their partition values) and
+# rows of files that were removed are dropped. Changing the indexed columns rebuilds it.
+def update_skipping_index(table_name, columns:List[str], bloom_columns:List[str]=None):
+  bloom_columns = bloom_columns or []
+  location = spark.sql(f"DESCRIBE DETAIL {table_name}").first()["location"]
+  index_path = skipping_index_path(table_name)
+  live = set(spark.read.table(table_name).inputFiles())
+
+  try:
+    index = spark.read.format("delta").load(index_path)
+    expected = set(f"{index_column_name(c)}__{s}" for c in columns for s in ["min", "max", "nulls"]) | set(f"{index_column_name(c)}__bloom" for c in bloom_columns)
+    if not expected <= set(index.columns): raise ValueError("The indexed columns changed")
+    indexed = set(r["file"] for r in index.select("file").collect())
+  except Exception:
+    index, indexed = None, set()
+
+  added = BI.sorted(live - indexed)
+  removed = indexed - live
+  if not added and not removed:
+    return {"files": BI.len(live), "added": 0, "removed": 0}
+
+  summaries = None
+  if added:
+    summaries = file_summaries(spark.read.option("basePath", location).parquet(*added), columns, bloom_columns)
+  if index is not None:
+    kept = index.filter(~FT.col("file").isin(BI.list(removed))) if removed else index
+    summaries = kept.unionByName(summaries) if summaries is not None else kept
+
+  # The summaries are small; materialize them before overwriting the table they may be read from
+  summaries = spark.createDataFrame(summaries.collect(), summaries.schema)
+  summaries.write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(index_path)
+
+  print(f"Indexed {table_name}: {BI.len(added):,d} files added, {BI.len(removed):,d} removed, {BI.len(live):,d} total")
+  return {"files": BI.len(live), "added": BI.len(added), "removed": BI.len(removed)}
+
+# Returns the table's rows matching filters, a dict of column to value (or list of values),
+# scanning only the files whose summaries admit a match: a file is skipped when every value
+# is outside its [min, max], the column is entirely null, or its bloom filter rules the
+# values out. The index is brought up to date first. The files skipped are reported and
+# kept in skipping_index_reports.
+def prune_with_skipping_index(table_name, filters:dict, columns:List[str]=None, bloom_columns:List[str]=None):
+  bloom_columns = bloom_columns or []
+  columns = columns or BI.list(filters.keys())
+  update_skipping_index(table_name, columns, bloom_columns)
+  location = spark.sql(f"DESCRIBE DETAIL {table_name}").first()["location"]
+  index = spark.read.format("delta").load(skipping_index_path(table_name))
+
+  keep = FT.lit(True)
+  for column, value in filters.items():
+    values = BI.list(value) if isinstance(value, (list, tuple, set)) else [value]
+    n = index_column_name(column)
+    if f"{n}__min" in index.columns:
+      in_range = reduce(lambda a, b: a | b, [(FT.col(f"{n}__min") <= FT.lit(v)) & (FT.col(f"{n}__max") >= FT.lit(v)) for v in values])
+      keep = keep & in_range & (FT.col(f"{n}__nulls") < FT.col("rows"))
+    if f"{n}__bloom" in index.columns:
+      # The bit positions of each value, computed with the same expressions (and type) as the index
+      data_type = spark.read.table(table_name).select(column).schema[0].dataType
+      positions = spark.range(1).select(*[bloom_positions(FT.lit(v).cast(data_type)).alias(f"_{i}") for i, v in enumerate(values)]).first()
+      keep = keep & reduce(lambda a, b: a | b, [FT.expr(f"size(array_except(array({', '.join(str(p) for p in ps)}), {n}__bloom)) = 0") for ps in positions])
+
+  files = [r["file"] for r in index.select("file", keep.alias("keep")).collect() if r["keep"]]
+  total = index.count()
+  skipping_index_reports[table_name] = {"files": total, "scanned": BI.len(files), "skipped": total - BI.len(files)}
+  print(f"Skipped {total - BI.len(files):,d} of {total:,d} files of {table_name}")
+
+  schema = spark.read.table(table_name).schema
+  df = spark.read.schema(schema).option("basePath", location).parquet(*files) if files else spark.createDataFrame([], schema)
+  for column, value in filters.items():
+    df = df.filter(FT.col(column).isin(BI.list(value)) if isinstance(value, (list, tuple, set)) else FT.col(column) == value)
+  return df
+
+#############################################
+# Z-order clustering
+#############################################
+
+# How well the table's files are clustered on each column, from the data-skipping index:
+# the average number of files whose [min, max] overlaps a given file's range (1.0 is
+# perfect) and that as a fraction of all files, roughly the share of files a point
+# lookup on the column has to read.
+def clustering_quality(table_name, columns:List[str]) -> dict:
+  update_skipping_index(table_name, columns)
+  index = spark.read.format("delta").load(skipping_index_path(table_name)).collect()
+
+  quality = dict()
+  for column in columns:
+    n = index_column_name(column)
+    ranges = [(r[f"{n}__min"], r[f"{n}__max"]) for r in index if r[f"{n}__min"] is not None]
+    depth = BI.sum(BI.sum(1 for lo, hi in ranges if lo <= f_hi and hi >= f_lo) for f_lo, f_hi in ranges) / BI.max(1, BI.len(ranges))
+    quality[column] = {"files": BI.len(ranges), "avg_overlap": BI.round(depth, 2), "scan_fraction": BI.round(depth / BI.max(1, BI.len(ranges)), 4)}
+  return quality
+
+# An order-preserving long for a column: numbers as is, strings by their first 7 bytes
+def zorder_key(df, column):
+  data_type = df.select(column).schema[0].dataType.typeName()
+  # The first 7 bytes, right-padded with zero bytes so that "B" still sorts after "AA"
+  if data_type == "string": return FT.conv(FT.rpad(FT.hex(FT.substring(FT.col(column).cast("binary"), 1, 7)), 14, "0"), 16, 10).cast("long")
+  if data_type in ["timestamp", "date"]: return FT.col(column).cast("timestamp").cast("long")
+  return FT.col(column).cast("double")
+
+# The Z-order value of the columns: each column is bucketed by its approximate quantiles
+# into 2^bits ranks and the ranks' bits are interleaved
+def zorder_value(df, columns:List[str]):
+  from pyspark.ml.feature import Bucketizer
+
+  bits = BI.min(16, 62 // BI.len(columns))
+  names = [f"_z_key_{i}" for i in range(BI.len(columns))]
+  df = df.select("*", *[zorder_key(df, c).cast("double").alias(k) for c, k in BI.zip(columns, names)])
+
+  probabilities = [i / (2**bits) for i in range(1, 2**bits)]
+  for name, quantiles in BI.zip(names, df.approxQuantile(names, probabilities, 0.001)):
+    if not quantiles: # No rows, or only nulls: a Bucketizer needs at least three splits
+      df = df.withColumn(f"{name}_rank", FT.lit(0.0))
+      continue
+    splits = [float("-inf")] + BI.sorted(set(quantiles)) + [float("inf")]
+    df = Bucketizer(splits=splits, inputCol=name, outputCol=f"{name}_rank", handleInvalid="keep").transform(df)
+
+  z = FT.lit(0).cast("long")
+  for b in range(bits):
+    for i, name in enumerate(names):
+      bit = FT.shiftRight(FT.col(f"{name}_rank").cast("long"), b).bitwiseAND(1)
+      z = z.bitwiseOR(FT.shiftLeft(bit, b * BI.len(names) + i))
+  return df.withColumn("_z", z).drop(*names, *[f"{n}_rank" for n in names])
+
+# Rewrites the table, or the rows matching partition_filter (a SQL predicate on partition
+# columns), so that rows are range-partitioned and sorted by the Z-order of columns; every
+# file then holds a compact box of those columns and has tight min/max ranges on all of
+# them. Uses OPTIMIZE ... ZORDER BY when the runtime provides it. Partition columns are
+# already clustered and are left out, of both the rewrite and the clustering quality
+# reported before and after.
+def zorder_table(table_name, columns:List[str], partition_filter:str=None, target_file_bytes=128*1024*1024) -> dict:
+  detail = spark.sql(f"DESCRIBE DETAIL {table_name}").first()
+  partition_by = BI.list(detail["partitionColumns"])
+  columns = [c for c in columns if c not in partition_by]
+  if not columns: raise ValueError(f"Expected at least one column that does not partition {table_name}")
+  before = clustering_quality(table_name, columns)
+
+  try:
+    where = f" WHERE {partition_filter}" if partition_filter else ""
+    spark.sql(f"OPTIMIZE {table_name}{where} ZORDER BY ({', '.join(columns)})")
+  except ParseException as e:
+    # Open-source Delta prior to 2.0 can't parse OPTIMIZE ... ZORDER; rewrite the rows ourselves.
+    # Any other failure, e.g. a bad column or a concurrent write, is raised as is.
+    if "'OPTIMIZE'" not in str(e) and "'ZORDER'" not in str(e): raise
+    df = spark.read.table(table_name)
+    total_rows = df.count()
+    if partition_filter: df = df.filter(partition_filter)
+    # The rewritten bytes are estimated from the table's size on disk and its row count
+    rows = df.count() if partition_filter else total_rows
+    if rows == 0: return {"before": before, "after": before}
+    num_files = BI.max(1, math.ceil(detail["sizeInBytes"] * rows / total_rows / target_file_bytes))
+
+    clustered = zorder_value(df, columns).repartitionByRange(num_files, *partition_by, "_z").sortWithinPartitions(*partition_by, "_z").drop("_z")
+    writer = clustered.write.format("delta").mode("overwrite")
+    if partition_filter: writer = writer.option("replaceWhere", partition_filter)
+    if partition_by: writer = writer.partitionBy(*partition_by)
+    writer.saveAsTable(table_name)
+
+  after = clustering_quality(table_name, columns)
+  for column in columns:
+    print(f"""{table_name}.{column}: files scanned by a point lookup {before[column]["scan_fraction"]:.1%} -> {after[column]["scan_fraction"]:.1%}""")
+  return {"before": before, "after": after}
+
+#############################################
+# Fact & dim targets for the batched orders
+#############################################
+
+sales_rep_columns = ["sales_rep_id", "sales_rep_ssn", "sales_rep_first_name", "sales_rep_last_name", "sales_rep_address", "sales_rep_city", "sales_rep_state", "sales_rep_zip"]
+order_columns = ["submitted_at", "order_id", "customer_id", "sales_rep_id", "shipping_address_attention", "shipping_address_address", "shipping_address_city", "shipping_address_state", "shipping_address_zip"]
+line_item_columns = ["order_id", "product_id", "product_quantity", "product_sold_price"]
+
+def to_sales_reps(df):
+  return (df.select(*sales_rep_columns, *ingest_columns)
+            .withColumn("_error_ssn_format", FT.col("sales_rep_ssn").contains("-"))
+            .withColumn("sales_rep_ssn", FT.regexp_replace("sales_rep_ssn", "-", "").cast("long"))
+            .withColumn("sales_rep_zip", FT.col("sales_rep_zip").cast("integer")))
+
+def to_orders(df):
+  return (df.select(*order_columns, *ingest_columns)
+            .withColumn("submitted_at", FT.from_unixtime("submitted_at").cast("timestamp"))
+            .withColumn("shipping_address_zip", FT.col("shipping_address_zip").cast("integer"))
+            .withColumn("submitted_yyyy_mm", FT.date_format("submitted_at", "yyyy-MM")))
+
+def to_line_items(df):
+  return (df.select(*line_item_columns, *ingest_columns)
+            .withColumn("product_quantity", FT.col("product_quantity").cast("integer"))
+            .withColumn("product_sold_price", FT.col("product_sold_price").cast("decimal(10,2)")))
+
+# The keys Exercise #3 deduplicates the sales reps on
+sales_rep_dedup_columns = ["sales_rep_id", "sales_rep_ssn", "sales_rep_first_name", "sales_rep_city", "sales_rep_state", "sales_rep_zip", "_error_ssn_format"]
+
+# The three Exercise #3 tables as fan-out targets, deduplicated while excluding the ingest columns,
+# e.g. fan_out_write(spark.read.table(batch_temp_view), batch_orders_targets()).
+# The shared intermediate is persisted, which keeps the hash dedup's row ids stable.
+def batch_orders_targets() -> List[FanOutTarget]:
+  return [
+    FanOutTarget(sales_reps_table, to_sales_reps, dedup=sales_rep_dedup_columns, columns=sales_rep_columns+ingest_columns, hashed=True),
+    FanOutTarget(orders_table, to_orders, dedup=order_columns, columns=order_columns+ingest_columns, partition_by=["submitted_yyyy_mm"], hashed=True),
+    FanOutTarget(line_items_table, to_line_items, columns=line_item_columns+ingest_columns),
+  ]
+
+None # Suppress output
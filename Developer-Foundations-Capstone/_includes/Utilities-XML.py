@@ -0,0 +1,251 @@
+# Databricks notebook source
+import os
+import re
+from pyspark.sql.types import *
+
+#############################################
+# Row-tag XML splitting
+#############################################
+
+# Byte ranges of roughly split_bytes each; a row belongs to the range in which its start tag begins
+def xml_splits(path, split_bytes=64*1024*1024):
+  size = os.path.getsize(to_local_path(path))
+  return [(start, BI.min(start + split_bytes, size)) for start in range(0, size, split_bytes)]
+
+def row_tag_pattern(row_tag):
+  # "<product" must be followed by whitespace, ">" or "/>" so that "<products>" does not match
+  return re.compile(b"<" + re.escape(row_tag.encode("utf-8")) + rb"[\s>/]")
+
+# Yields the offset of every row start tag beginning in [start, end), reading chunk_bytes at a time
+def xml_row_offsets(path, row_tag, start, end, chunk_bytes=8*1024*1024):
+  pattern = row_tag_pattern(row_tag)
+  overlap = BI.len(row_tag) + 2
+  with open(to_local_path(path), "rb") as f:
+    pos = start
+    while pos < end:
+      limit = BI.min(chunk_bytes, end - pos)
+      f.seek(pos)
+      chunk = f.read(limit + overlap)
+      if not chunk: break
+      for match in pattern.finditer(chunk):
+        if match.start() < limit: yield pos + match.start()
+      pos += limit
+
+# Yields the raw bytes of each row element beginning in [start, end); memory is bounded by the largest row
+def xml_row_bytes(path, row_tag, start, end, block_bytes=64*1024):
+  close_tag = f"</{row_tag}>".encode("utf-8")
+  with open(to_local_path(path), "rb") as f:
+    for offset in xml_row_offsets(path, row_tag, start, end):
+      f.seek(offset)
+      buffer = b""
+      while True:
+        block = f.read(block_bytes)
+        if not block: break
+        buffer += block
+        first_gt = buffer.find(b">")
+        if first_gt > 0 and buffer[first_gt-1:first_gt] == b"/":
+          yield buffer[:first_gt+1] # Self-closing row
+          break
+        end_tag = buffer.find(close_tag)
+        if end_tag >= 0:
+          yield buffer[:end_tag+BI.len(close_tag)]
+          break
+
+#############################################
+# Row decoding, following spark-xml's naming
+#############################################
+
+# Attributes become "_name" fields, child elements become fields named by their tag
+# (repeated children become lists) and the text of an element that also has attributes
+# or children becomes "_VALUE", as spark-xml does
+def xml_element_to_value(element, attribute_prefix="_", value_tag="_VALUE"):
+  text = (element.text or "").strip()
+  children = BI.list(element)
+  if not element.attrib and not children:
+    return text if text else None
+
+  value = {f"{attribute_prefix}{k}": v for k, v in element.attrib.items()}
+  for child in children:
+    child_value = xml_element_to_value(child, attribute_prefix, value_tag)
+    if child.tag in value:
+      if not isinstance(value[child.tag], list): value[child.tag] = [value[child.tag]]
+      value[child.tag].append(child_value)
+    else:
+      value[child.tag] = child_value
+  if text: value[value_tag] = text
+  return value
+
+# Parses an xs:dateTime, e.g. 2019-01-02T03:04:05.1Z, into a datetime; fromisoformat()
+# accepts neither the "Z" suffix nor fractions other than 3 or 6 digits before Python 3.11
+def xml_timestamp(value):
+  from datetime import datetime
+  value = re.sub(r"Z$", "+00:00", value.strip())
+  value = re.sub(r"\.(\d+)", lambda m: "." + (m.group(1) + "000000")[:6], value)
+  return datetime.fromisoformat(value)
+
+# Converts a decoded value to the Python type Spark expects for data_type
+def xml_cast(value, data_type, value_tag="_VALUE"):
+  from decimal import Decimal
+  from datetime import date
+  if value is None: return None
+  if isinstance(data_type, StructType):
+    if not isinstance(value, dict): value = {value_tag: value}
+    return tuple(xml_cast(value.get(f.name), f.dataType, value_tag) for f in data_type.fields)
+  if isinstance(data_type, ArrayType):
+    return [xml_cast(v, data_type.elementType, value_tag) for v in (value if isinstance(value, list) else [value])]
+  if isinstance(value, (dict, list)): return None # Structure does not match the schema
+  if isinstance(data_type, (IntegerType, LongType, ShortType, ByteType)): return int(value)
+  if isinstance(data_type, (DoubleType, FloatType)): return float(value)
+  if isinstance(data_type, DecimalType): return Decimal(value)
+  if isinstance(data_type, BooleanType): return value.lower() == "true"
+  if isinstance(data_type, DateType): return date.fromisoformat(value.strip()[:10]) # Drops any timezone suffix
+  if isinstance(data_type, TimestampType): return xml_timestamp(value)
+  return value
+
+def parse_xml_rows(path, row_tag, schema, start, end, value_tag="_VALUE"):
+  import xml.etree.ElementTree as ET
+  for raw in xml_row_bytes(path, row_tag, start, end):
+    yield xml_cast(xml_element_to_value(ET.fromstring(raw), value_tag=value_tag), schema, value_tag)
+
+# An all-string schema built from the first sample_rows rows only, for when no XSD
+# (see compile_xsd below) is available; it never scans the whole document
+def sample_xml_schema(path, row_tag, sample_rows=100):
+  import xml.etree.ElementTree as ET
+  from itertools import islice
+
+  def merge(fields, value):
+    for name, v in value.items():
+      if isinstance(v, list): v = v[0]
+      if isinstance(v, dict): fields[name] = merge(fields.get(name) if isinstance(fields.get(name), dict) else {}, v)
+      elif name not in fields: fields[name] = None
+    return fields
+
+  def to_struct(fields):
+    return StructType([StructField(n, to_struct(f) if isinstance(f, dict) else StringType(), True) for n, f in BI.sorted(fields.items())])
+
+  fields = {}
+  size = os.path.getsize(to_local_path(path))
+  for raw in islice(xml_row_bytes(path, row_tag, 0, size), sample_rows):
+    fields = merge(fields, xml_element_to_value(ET.fromstring(raw)))
+  return to_struct(fields)
+
+#############################################
+# XSD to StructType
+#############################################
+
+xsd_namespace = "{http://www.w3.org/2001/XMLSchema}"
+
+xsd_simple_types = {
+  "string": StringType(), "normalizedString": StringType(), "token": StringType(), "anyURI": StringType(),
+  "boolean": BooleanType(),
+  "byte": ByteType(), "short": ShortType(), "int": IntegerType(), "long": LongType(),
+  "integer": LongType(), "positiveInteger": LongType(), "nonNegativeInteger": LongType(),
+  "float": FloatType(), "double": DoubleType(),
+  "date": DateType(), "dateTime": TimestampType()
+}
+
+# Compiles the declaration of the element row_tag in an XSD into the StructType spark-xml
+# would produce for it: attributes are prefixed with attribute_prefix, simple content next
+# to attributes becomes value_tag, maxOccurs > 1 becomes an array and decimal types honour
+# their totalDigits & fractionDigits facets. Named types are resolved against the document.
+def compile_xsd(xsd_path, row_tag, attribute_prefix="_", value_tag="_VALUE"):
+  import xml.etree.ElementTree as ET
+
+  with open(to_local_path(xsd_path), "rb") as f:
+    root = ET.parse(f).getroot()
+
+  def local(name): return name.split(":")[-1] if name else None
+  named_complex = {e.get("name"): e for e in root.findall(f"{xsd_namespace}complexType")}
+  named_simple = {e.get("name"): e for e in root.findall(f"{xsd_namespace}simpleType")}
+
+  def simple_type(type_name, restriction=None):
+    if type_name in named_simple:
+      return simple_type(None, named_simple[type_name].find(f"{xsd_namespace}restriction"))
+    if restriction is not None:
+      base = local(restriction.get("base"))
+      if base == "decimal":
+        facet = lambda n, d: int(restriction.find(f"{xsd_namespace}{n}").get("value")) if restriction.find(f"{xsd_namespace}{n}") is not None else d
+        precision = facet("totalDigits", 38)
+        return DecimalType(precision, BI.min(precision, facet("fractionDigits", 18))) # The scale may not exceed the precision
+      return simple_type(base)
+    if type_name == "decimal": return DecimalType(38, 18)
+    return xsd_simple_types.get(type_name, StringType())
+
+  def attributes(node):
+    return [StructField(attribute_prefix + a.get("name"), simple_type(local(a.get("type")), a.find(f"{xsd_namespace}simpleType/{xsd_namespace}restriction")), True)
+            for a in node.findall(f"{xsd_namespace}attribute")]
+
+  def complex_type(node):
+    fields = []
+    content = node.find(f"{xsd_namespace}simpleContent/{xsd_namespace}extension")
+    if content is not None:
+      fields.append(StructField(value_tag, simple_type(local(content.get("base"))), True))
+      fields.extend(attributes(content))
+      return StructType(fields)
+    for group in ["sequence", "all", "choice"]:
+      for child in node.findall(f"{xsd_namespace}{group}/{xsd_namespace}element"):
+        fields.append(element(child))
+    fields.extend(attributes(node))
+    return StructType(fields)
+
+  def element_type(node):
+    type_name = local(node.get("type"))
+    if node.find(f"{xsd_namespace}complexType") is not None: return complex_type(node.find(f"{xsd_namespace}complexType"))
+    if type_name in named_complex: return complex_type(named_complex[type_name])
+    return simple_type(type_name, node.find(f"{xsd_namespace}simpleType/{xsd_namespace}restriction"))
+
+  def element(node):
+    data_type = element_type(node)
+    max_occurs = node.get("maxOccurs", "1")
+    if max_occurs == "unbounded" or int(max_occurs) > 1: data_type = ArrayType(data_type, True)
+    return StructField(node.get("name"), data_type, True) # spark-xml reads every field as nullable
+
+  row = next((e for e in root.iter(f"{xsd_namespace}element") if e.get("name") == row_tag), None)
+  if row is None: raise ValueError(f"The element \"{row_tag}\" is not declared in {xsd_path}")
+  # Each row is read on its own, so the row element's own maxOccurs does not apply
+  return element_type(row)
+
+#############################################
+# Readers
+#############################################
+
+# Reads a row-tagged XML document, e.g. rowTag="product" under rootTag="products", as a
+# DataFrame without a DOM or an inference pass: the file is split at byte ranges, every
+# task seeks to the first row start tag in its range and decodes one row at a time.
+def read_xml(path, row_tag, schema=None, split_bytes=64*1024*1024):
+  schema = schema or sample_xml_schema(path, row_tag)
+  splits = xml_splits(path, split_bytes)
+  rdd = sc.parallelize(splits, BI.max(1, BI.len(splits))).flatMap(lambda s: parse_xml_rows(path, row_tag, schema, s[0], s[1]))
+  return spark.createDataFrame(rdd, schema)
+
+# Yields Arrow record batches of up to batch_rows rows, parsed on the driver
+def read_xml_arrow(path, row_tag, schema=None, batch_rows=10000):
+  import pyarrow as pa
+
+  schema = schema or sample_xml_schema(path, row_tag)
+  names = [f.name for f in schema.fields]
+
+  def to_dict(value, data_type):
+    if value is None or not isinstance(data_type, StructType): return value
+    return {f.name: to_dict(v, f.dataType) for f, v in BI.zip(data_type.fields, value)}
+
+  def to_batch(rows):
+    columns = BI.list(BI.zip(*rows))
+    return pa.RecordBatch.from_arrays([pa.array([to_dict(v, f.dataType) for v in c]) for f, c in BI.zip(schema.fields, columns)], names=names)
+
+  rows = []
+  for start, end in xml_splits(path):
+    for row in parse_xml_rows(path, row_tag, schema, start, end):
+      rows.append(row)
+      if BI.len(rows) == batch_rows:
+        yield to_batch(rows)
+        rows = []
+  if rows: yield to_batch(rows)
+
+# Counts rows by scanning for row start tags in parallel; no field is decoded
+def count_xml_rows(path, row_tag, split_bytes=64*1024*1024):
+  splits = xml_splits(path, split_bytes)
+  if BI.len(splits) == 0: return 0
+  return sc.parallelize(splits, BI.len(splits)).map(lambda s: BI.sum(1 for _ in xml_row_offsets(path, row_tag, s[0], s[1]))).sum()
+
+None # Suppress output
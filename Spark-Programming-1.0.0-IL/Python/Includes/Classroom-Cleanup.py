@@ -1,3 +1,3 @@
 # Databricks notebook source
 
-classroomCleanup(username, moduleName, True)
+cleanupReport = classroomCleanup(username, moduleName, True)
@@ -4,9 +4,6 @@
 
 # COMMAND ----------
 
-spark.sql("""CREATE TABLE IF NOT EXISTS events USING parquet OPTIONS (path "{}")""".format(eventsPath))
-spark.sql("""CREATE TABLE IF NOT EXISTS sales USING parquet OPTIONS (path "{}")""".format(salesPath))
-spark.sql("""CREATE TABLE IF NOT EXISTS users USING parquet OPTIONS (path "{}")""".format(usersPath))
-spark.sql("""CREATE TABLE IF NOT EXISTS products USING parquet OPTIONS (path "{}")""".format(productsPath))
+registerTables({"events": eventsPath, "sales": salesPath, "users": usersPath, "products": productsPath})
 
 displayHTML("")
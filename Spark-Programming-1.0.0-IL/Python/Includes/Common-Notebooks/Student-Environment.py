@@ -51,6 +51,62 @@ def getWorkingDir() -> str:
   workingDir = "{}/{}/{}".format(getUserhome(), moduleName, langType)
   return workingDir.replace("__", "_").replace("__", "_").replace("__", "_").replace("__", "_")
     
+############################################
+# SETUP FINGERPRINT FUNCTIONS
+############################################
+
+# The setup records what it created (module, user, database & registered tables, with a
+# signature of each table's data) so that a re-run can verify it and skip the work already done
+fingerprintKey = "com.databricks.training.setup-fingerprint"
+
+def getFingerprint() -> dict:
+  import json
+  try:
+    return json.loads(spark.conf.get(fingerprintKey))
+  except:
+    return {}
+
+def updateFingerprint(**entries) -> dict:
+  import json
+  fingerprint = getFingerprint()
+  fingerprint.update(entries)
+  spark.conf.set(fingerprintKey, json.dumps(fingerprint))
+  return fingerprint
+
+def clearFingerprint():
+  spark.conf.unset(fingerprintKey)
+
+# The table's location with the entries directly under it (their number, total bytes and
+# latest modification) and, for Delta, its version: a checksum of its data that changes when
+# the table is overwritten or replaced. Only the top level is listed, as large datasets have
+# too many files to walk on every setup.
+def tableSignature(tableName:str) -> str:
+  location = [r["data_type"] for r in spark.sql("DESCRIBE FORMATTED {}".format(tableName)).collect() if r["col_name"] == "Location"][0]
+  path = sc._jvm.org.apache.hadoop.fs.Path(location)
+  entries = path.getFileSystem(sc._jsc.hadoopConfiguration()).listStatus(path)
+  names = set(e.getPath().getName() for e in entries)
+  version = spark.sql("DESCRIBE HISTORY delta.`{}` LIMIT 1".format(location)).first()["version"] if "_delta_log" in names else None
+  return "{}|{}|{}|{}|{}".format(location, len(entries), __builtin__.sum(e.getLen() for e in entries), __builtin__.max([e.getModificationTime() for e in entries], default=0), version)
+
+# The registered tables whose data still matches the signature recorded when they were registered
+def unchangedTables() -> list:
+  unchanged = []
+  for name, table in getFingerprint().get("tables", {}).items():
+    try:
+      if tableSignature(name) == table["signature"]: unchanged.append(name)
+    except:
+      pass # Dropped or unreadable, so changed
+  return unchanged
+
+# True when nothing was created since the last setup: no streams, no working directory and
+# only the registered tables, unchanged. The setup's cleanup is then skipped.
+def environmentUnchanged() -> bool:
+  registered = getFingerprint().get("tables", {})
+  if len(spark.streams.active) > 0 or pathExists(workingDir):
+    return False
+  existing = set(t.name for t in spark.catalog.listTables(databaseName) if not t.isTemporary)
+  return existing == set(registered.keys()) and len(unchangedTables()) == len(registered)
+
 ############################################
 # USER DATABASE FUNCTIONS
 ############################################
@@ -68,11 +124,34 @@ def getDatabaseName(username:str, moduleName:str) -> str:
 def createUserDatabase(username:str, moduleName:str) -> str:
   databaseName = getDatabaseName(username, moduleName)
 
+  # Already created & in use by a previous run
+  fingerprint = getFingerprint()
+  databaseExists = spark._jsparkSession.catalog().databaseExists(databaseName) # Not in the Python API before Spark 3.3
+  if fingerprint.get("database") == databaseName and databaseExists and spark.catalog.currentDatabase() == databaseName:
+    return databaseName
+
   spark.sql("CREATE DATABASE IF NOT EXISTS {}".format(databaseName))
   spark.sql("USE {}".format(databaseName))
 
   return databaseName
 
+# Register the tables (by name & path) unless a previous run already registered them; the
+# setup's cleanup drops any registered table whose data changed since
+def registerTables(tables:dict) -> list:
+  registered = getFingerprint().get("tables", {})
+  existing = set(t.name for t in spark.catalog.listTables(databaseName))
+  created = []
+
+  for name, path in tables.items():
+    if registered.get(name, {}).get("path") != path or name not in existing:
+      spark.sql("DROP TABLE IF EXISTS {}".format(name))
+      spark.sql("""CREATE TABLE {} USING parquet OPTIONS (path "{}")""".format(name, path))
+      registered[name] = {"path": path, "signature": tableSignature(name)}
+      created.append(name)
+
+  updateFingerprint(tables=registered)
+  return created
+
 # ****************************************************************************
 # Utility method to determine whether a path exists
 # ****************************************************************************
@@ -87,74 +166,148 @@ def pathExists(path):
 # ****************************************************************************
 # Utility method for recursive deletes
 # Note: dbutils.fs.rm() does not appear to be truely recursive
+# The tree is split into subtrees that a pool of workers removes concurrently,
+# returning the number of subtrees & files removed
 # ****************************************************************************
 
-def deletePath(path):
-  files = dbutils.fs.ls(path)
+def deletePath(path, maxWorkers=8) -> int:
+  from concurrent.futures import ThreadPoolExecutor
 
-  for file in files:
-    deleted = dbutils.fs.rm(file.path, True)
-    
-    if deleted == False:
-      if file.is_dir:
-        deletePath(file.path)
-      else:
-        raise IOError("Unable to delete file: " + file.path)
-  
-  if dbutils.fs.rm(path, True) == False:
+  listAll = lambda pool, dirs: [f for files in pool.map(lambda d: dbutils.fs.ls(d.path), dirs) for f in files]
+  removed = 0
+
+  with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+    # Expand directories until there is enough work to go around
+    units = dbutils.fs.ls(path)
+    while len(units) < maxWorkers * 4 and any(f.is_dir for f in units):
+      units = [f for f in units if not f.is_dir] + listAll(pool, [f for f in units if f.is_dir])
+
+    while len(units) > 0:
+      results = list(pool.map(lambda f: dbutils.fs.rm(f.path, True), units))
+      failed = [f for f, deleted in zip(units, results) if deleted == False]
+      removed += len(units) - len(failed)
+
+      for file in failed:
+        if not file.is_dir:
+          raise IOError("Unable to delete file: " + file.path)
+
+      units = listAll(pool, failed)
+
+  # Only the emptied directories remain
+  if dbutils.fs.rm(path, True) == False or pathExists(path):
     raise IOError("Unable to delete directory: " + path)
 
+  return removed
+
 # ****************************************************************************
-# Utility method to clean up the workspace at the end of a lesson
+# Utility method to drop all tables from a database concurrently
+# The drops are confirmed by re-listing the warehouse, removing any files left behind
+# ****************************************************************************
+
+def dropTables(database:str, maxWorkers=8, keep=None) -> list:
+  from concurrent.futures import ThreadPoolExecutor
+
+  tables = [row["tableName"] for row in spark.sql("show tables from {}".format(database)).filter("isTemporary = false").select("tableName").collect()]
+  tables = [t for t in tables if t not in (keep or [])]
+  if len(tables) == 0: return tables
+
+  hivePath = "dbfs:/user/hive/warehouse/{}.db".format(database)
+
+  with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+    list(pool.map(lambda tableName: spark.sql("drop table if exists {}.{}".format(database, tableName)), tables))
+
+    # In some rare cases the files don't actually get removed.
+    leftovers = [f.path for f in dbutils.fs.ls(hivePath) if f.name.rstrip("/") in tables] if pathExists(hivePath) else []
+    list(pool.map(lambda path: dbutils.fs.rm(path, True), leftovers)) # Ignoring the delete's success or failure
+
+  return tables
+
+# ****************************************************************************
+# Utility method to stop streams concurrently within a global deadline
+# Every query is signaled at once; those still running after cancelAfter seconds
+# have their job group (the query's runId) cancelled. Returns a report per query.
 # ****************************************************************************
 
-def classroomCleanup(username:str, moduleName:str, dropDatabase:str): 
+def stopStreams(queries=None, timeout=60, cancelAfter=15) -> list:
   import time
+  from concurrent.futures import ThreadPoolExecutor, wait
   
+  queries = list(spark.streams.active) if queries is None else list(queries)
+  if len(queries) == 0: return []
+
+  start = time.monotonic()
+  reports = [{"name": q.name, "id": q.id, "runId": q.runId, "stopped": False, "cancelled": False, "seconds": None, "error": None} for q in queries]
+
+  def stop(query, report):
+    try:
+      query.stop() # Blocks until the query terminates
+    except Exception as e:
+      report["error"] = str(e) # In extream cases, this funtion may throw an ignorable error.
+    report["seconds"] = time.monotonic() - start
+
+  pool = ThreadPoolExecutor(max_workers=len(queries))
+  futures = [pool.submit(stop, q, r) for q, r in zip(queries, reports)]
+  done, pending = wait(futures, timeout=min(cancelAfter, timeout))
+
+  if len(pending) > 0:
+    for query, report, future in zip(queries, reports, futures):
+      if future in pending:
+        sc.cancelJobGroup(str(query.runId))
+        report["cancelled"] = True
+    wait(pending, timeout=__builtin__.max(0, timeout - (time.monotonic() - start)))
+
+  pool.shutdown(wait=False) # Don't let a stuck query hold up the caller past the deadline
+  for query, report in zip(queries, reports):
+    report["stopped"] = not query.isActive
+
+  return reports
+
+# ****************************************************************************
+# Utility method to clean up the workspace at the end of a lesson
+# Returns a report of the objects removed and the time taken
+# The tables registered by the setup are kept unless the database is dropped
+# ****************************************************************************
+
+def classroomCleanup(username:str, moduleName:str, dropDatabase:str) -> dict: 
+  import time
+  start = time.time()
+  report = {"tables": [], "files": 0, "database": None}
+
   # Stop any active streams
-  for stream in spark.streams.active:
-    stream.stop()
-    
-    # Wait for the stream to stop
-    queries = list(filter(lambda query: query.name == stream.name, spark.streams.active))
-    
-    while (len(queries) > 0):
-      time.sleep(5) # Give it a couple of seconds
-      queries = list(filter(lambda query: query.name == stream.name, spark.streams.active))
+  report["streams"] = stopStreams()
   
   # Drop all tables from the specified database
   database = getDatabaseName(username, moduleName)
+  keep = [] if dropDatabase else unchangedTables()
   try:
-    tables = spark.sql("show tables from {}".format(database)).select("tableName").collect()
-    for row in tables:
-      tableName = row["tableName"]
-      spark.sql("drop table if exists {}.{}".format(database, tableName))
-
-      # In some rare cases the files don't actually get removed.
-      time.sleep(1) # Give it just a second...
-      hivePath = "dbfs:/user/hive/warehouse/{}.db/{}".format(database, tableName)
-      dbutils.fs.rm(hivePath, True) # Ignoring the delete's success or failure
-    
-
+    report["tables"] = dropTables(database, keep=keep)
   except:
     pass # ignored
+  tables = getFingerprint().get("tables", {})
+  updateFingerprint(tables={name: tables[name] for name in keep})
 
   # Remove any files that may have been created from previous runs
   path = getWorkingDir()
   if pathExists(path):
-    deletePath(path)  
+    report["files"] = deletePath(path)
   
   # The database should only be dropped in a "cleanup" notebook, not "setup"
   if dropDatabase: 
     spark.sql("DROP DATABASE IF EXISTS {} CASCADE".format(database))
+    report["database"] = database
+    clearFingerprint()
     
     # In some rare cases the files don't actually get removed.
-    time.sleep(1) # Give it just a second...
     hivePath = "dbfs:/user/hive/warehouse/{}.db".format(database)
-    dbutils.fs.rm(hivePath, True) # Ignoring the delete's success or failure
+    if pathExists(hivePath):
+      dbutils.fs.rm(hivePath, True) # Ignoring the delete's success or failure
     
-    displayHTML("Dropped database and removed files in working directory")
+  report["seconds"] = time.time() - start
+
+  if dropDatabase: 
+    displayHTML("Dropped database and removed files in working directory ({} tables and {} files in {:.1f} seconds)".format(len(report["tables"]), report["files"], report["seconds"]))
 
+  return report
   
 # Utility method to delete a database  
 def deleteTables(database):
@@ -162,15 +315,23 @@ def deleteTables(database):
   
 # ****************************************************************************
 # Placeholder variables for coding challenge type specification
+# DATAFRAME is only created on first use
 # ****************************************************************************
-class FILL_IN:
+class LazyFillIn(type):
+  @property
+  def DATAFRAME(cls):
+    if cls._dataframe is None:
+      cls._dataframe = sqlContext.createDataFrame(sc.emptyRDD(), cls.SCHEMA)
+    return cls._dataframe
+
+class FILL_IN(metaclass=LazyFillIn):
   from pyspark.sql.types import Row, StructType
   VALUE = None
   LIST = []
   SCHEMA = StructType([])
   ROW = Row()
   INT = 0
-  DATAFRAME = sqlContext.createDataFrame(sc.emptyRDD(), StructType([]))
+  _dataframe = None
 
 ############################################
 # Set up student environment
@@ -182,4 +343,10 @@ userhome = getUserhome()
 workingDir = getWorkingDir()
 databaseName = createUserDatabase(username, moduleName)
 
-classroomCleanup(username, moduleName, False)
+if getFingerprint().get("database") != databaseName:
+  clearFingerprint() # Recorded for another module or user
+
+updateFingerprint(module=moduleName, user=username, database=databaseName, workingDir=workingDir)
+
+# Only clean up when something changed since the last setup
+cleanupReport = None if environmentUnchanged() else classroomCleanup(username, moduleName, False)
@@ -89,23 +89,58 @@
 # MAGIC     # In extream cases, this funtion may throw an ignorable error.
 # MAGIC     print("An [ignorable] error has occured while stoping the stream.")
 # MAGIC 
-# MAGIC def stopAllStreams():
-# MAGIC   streams = getActiveStreams()
-# MAGIC   while len(streams) > 0:
-# MAGIC     stopStream(streams[0])
-# MAGIC     streams = getActiveStreams()
+# MAGIC # Stops every stream concurrently, see stopStreams() in Student-Environment
+# MAGIC def stopAllStreams(timeout=60):
+# MAGIC   reports = stopStreams(getActiveStreams(), timeout)
+# MAGIC   for report in reports:
+# MAGIC     if report["stopped"]: print("The stream {} was stopped in {:.1f} seconds.".format(report["name"], report["seconds"] or timeout))
+# MAGIC     else: print("The stream {} did not stop within {} seconds.".format(report["name"], timeout))
+# MAGIC   return reports
 # MAGIC     
 # MAGIC # ****************************************************************************
 # MAGIC # Utility method to wait until the stream is read
 # MAGIC # ****************************************************************************
 # MAGIC 
-# MAGIC def untilStreamIsReady(name, progressions=3):
-# MAGIC   import time
-# MAGIC   queries = list(filter(lambda query: query.name == name or query.name == name + "_p", getActiveStreams()))
+# MAGIC import threading
+# MAGIC 
+# MAGIC # Notified on every start, progress & termination event when the streaming query
+# MAGIC # listener is available (Spark 3.4+), see streamEventsListening; otherwise waiters
+# MAGIC # re-check every pollSeconds
+# MAGIC try: streamEvents
+# MAGIC except NameError:
+# MAGIC   streamEvents = threading.Condition()
+# MAGIC   streamEventsListening = False
+# MAGIC   try:
+# MAGIC     from pyspark.sql.streaming import StreamingQueryListener
+# MAGIC     
+# MAGIC     class StreamEventsListener(StreamingQueryListener):
+# MAGIC       def notify(self):
+# MAGIC         with streamEvents: streamEvents.notify_all()
+# MAGIC       def onQueryStarted(self, event): self.notify()
+# MAGIC       def onQueryProgress(self, event): self.notify()
+# MAGIC       def onQueryIdle(self, event): pass
+# MAGIC       def onQueryTerminated(self, event): self.notify()
+# MAGIC     
+# MAGIC     spark.streams.addListener(StreamEventsListener())
+# MAGIC     streamEventsListening = True
+# MAGIC   except ImportError:
+# MAGIC     pass
 # MAGIC 
-# MAGIC   while (len(queries) == 0 or len(queries[0].recentProgress) < progressions):
-# MAGIC     time.sleep(5) # Give it a couple of seconds
+# MAGIC # Waits up to timeout seconds for the stream to report its progressions, then fails
+# MAGIC def untilStreamIsReady(name, progressions=3, timeout=300, pollSeconds=0.25):
+# MAGIC   import time
+# MAGIC   
+# MAGIC   def isReady():
 # MAGIC     queries = list(filter(lambda query: query.name == name or query.name == name + "_p", getActiveStreams()))
+# MAGIC     return len(queries) > 0 and len(queries[0].recentProgress) >= progressions
+# MAGIC   
+# MAGIC   deadline = time.monotonic() + timeout
+# MAGIC   with streamEvents:
+# MAGIC     while not isReady():
+# MAGIC       remaining = deadline - time.monotonic()
+# MAGIC       if remaining <= 0:
+# MAGIC         raise TimeoutError("The stream {} did not report {} progressions within {} seconds; is it running?".format(name, progressions, timeout))
+# MAGIC       streamEvents.wait(remaining if streamEventsListening else min(pollSeconds, remaining))
 # MAGIC 
 # MAGIC   print("The stream {} is active and ready.".format(name))
 
@@ -279,11 +314,23 @@
 # MAGIC   }
 # MAGIC }
 # MAGIC 
-# MAGIC def stopAllStreams():Unit = {
-# MAGIC   var streams = getActiveStreams()
-# MAGIC   while (streams.length > 0) {
-# MAGIC     stopStream(streams(0))
-# MAGIC     streams = getActiveStreams()
+# MAGIC // Signals every stream at once, cancelling the job group of any still running after
+# MAGIC // cancelAfterSeconds, and waits for all of them up to timeoutSeconds
+# MAGIC def stopAllStreams(timeoutSeconds:Int = 60, cancelAfterSeconds:Int = 15):Unit = {
+# MAGIC   import scala.concurrent.{Await, Future}
+# MAGIC   import scala.concurrent.duration._
+# MAGIC   import scala.concurrent.ExecutionContext.Implicits.global
+# MAGIC   
+# MAGIC   val streams = getActiveStreams()
+# MAGIC   val stopped = Future.sequence(streams.map(s => Future(stopStream(s))))
+# MAGIC   
+# MAGIC   try Await.ready(stopped, cancelAfterSeconds.seconds) catch {
+# MAGIC     case e:java.util.concurrent.TimeoutException => {
+# MAGIC       streams.filter(_.isActive).foreach(s => spark.sparkContext.cancelJobGroup(s.runId.toString))
+# MAGIC       try Await.ready(stopped, (timeoutSeconds - cancelAfterSeconds).max(0).seconds) catch {
+# MAGIC         case e:java.util.concurrent.TimeoutException => println(s"Some streams did not stop within $timeoutSeconds seconds.")
+# MAGIC       }
+# MAGIC     }
 # MAGIC   }
 # MAGIC }
 # MAGIC 
@@ -291,12 +338,40 @@
 # MAGIC // Utility method to wait until the stream is read
 # MAGIC // ****************************************************************************
 # MAGIC 
-# MAGIC def untilStreamIsReady(name:String, progressions:Int = 3):Unit = {
-# MAGIC   var queries = getActiveStreams().filter(s => s.name == name || s.name == name + "_s")
+# MAGIC // Woken by the listener on every start, progress & termination event
+# MAGIC val streamEvents = new Object()
+# MAGIC 
+# MAGIC class StreamEventsListener(events:Object) extends org.apache.spark.sql.streaming.StreamingQueryListener {
+# MAGIC   import org.apache.spark.sql.streaming.StreamingQueryListener._
+# MAGIC   def notifyWaiters():Unit = events.synchronized { events.notifyAll() }
+# MAGIC   override def onQueryStarted(event: QueryStartedEvent):Unit = notifyWaiters()
+# MAGIC   override def onQueryProgress(event: QueryProgressEvent):Unit = notifyWaiters()
+# MAGIC   override def onQueryTerminated(event: QueryTerminatedEvent):Unit = notifyWaiters()
+# MAGIC }
+# MAGIC 
+# MAGIC // A re-run of this notebook redefines the class, so the previous instance is found by name
+# MAGIC // and removed, keeping a single listener per session
+# MAGIC spark.streams.listListeners()
+# MAGIC   .filter(_.getClass.getName.endsWith("StreamEventsListener"))
+# MAGIC   .foreach(spark.streams.removeListener)
+# MAGIC 
+# MAGIC spark.streams.addListener(new StreamEventsListener(streamEvents))
+# MAGIC 
+# MAGIC // Waits up to timeoutSeconds for the stream to report its progressions, then fails
+# MAGIC def untilStreamIsReady(name:String, progressions:Int = 3, timeoutSeconds:Int = 300):Unit = {
+# MAGIC   def isReady():Boolean = {
+# MAGIC     val queries = getActiveStreams().filter(s => s.name == name || s.name == name + "_s")
+# MAGIC     queries.length > 0 && queries(0).recentProgress.length >= progressions
+# MAGIC   }
 # MAGIC   
-# MAGIC   while (queries.length == 0 || queries(0).recentProgress.length < progressions) {
-# MAGIC     Thread.sleep(5*1000) // Give it a couple of seconds
-# MAGIC     queries = getActiveStreams().filter(s => s.name == name || s.name == name + "_s")
+# MAGIC   val deadline = System.currentTimeMillis() + timeoutSeconds * 1000L
+# MAGIC   streamEvents.synchronized {
+# MAGIC     while (!isReady()) {
+# MAGIC       val remaining = deadline - System.currentTimeMillis()
+# MAGIC       if (remaining <= 0) throw new java.util.concurrent.TimeoutException(
+# MAGIC         s"The stream $name did not report $progressions progressions within $timeoutSeconds seconds; is it running?")
+# MAGIC       streamEvents.wait(remaining.min(1000)) // The 1 second cap only guards against a missed event
+# MAGIC     }
 # MAGIC   }
 # MAGIC   println("The stream %s is active and ready.".format(name))
 # MAGIC }